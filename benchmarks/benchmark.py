@@ -0,0 +1,340 @@
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import platform
+import itertools
+import statistics
+
+import torch
+
+from x_clip import CLIP
+from x_clip.mlm import MLM
+from x_clip.tokenizer import SimpleTokenizer
+from x_clip.visual_ssl import nt_xent_loss
+
+# benchmark harness for CLIP and its components
+# each result is written as one json line of {benchmark, params, metrics}, sorted by key, so runs across versions can be diffed
+
+# constants
+
+FEATURES = dict(
+    base = dict(),
+    all_token_embeds = dict(use_all_token_embeds = True),
+    extra_latent_projection = dict(extra_latent_projection = True),
+    decoupled_contrastive_learning = dict(decoupled_contrastive_learning = True),
+    mlm = dict(use_mlm = True),
+    mlm_single_pass = dict(use_mlm = True, mlm_single_text_pass = True),
+    simsiam = dict(use_visual_ssl = True, visual_ssl_type = 'simsiam'),
+    simclr = dict(use_visual_ssl = True, visual_ssl_type = 'simclr')
+)
+
+COMPONENTS = (
+    'text_transformer',
+    'visual_transformer',
+    'mlm',
+    'mlm.to_logits',
+    'visual_ssl',
+    'to_text_latent',
+    'to_visual_latent'
+)
+
+NUM_TEXT_TOKENS = 10000
+
+# helper functions
+
+def exists(val):
+    return val is not None
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def timed(fn, device, warmup = 2, repeats = 5):
+    # median wall clock seconds of fn over repeats, after warmup calls
+
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeats):
+        sync(device)
+        start = time.perf_counter()
+        fn()
+        sync(device)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+# peak memory
+# on cpu, the peak resident set size of the process, reset between benchmarks through /proc/self/clear_refs where available
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def get_peak_memory(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+# mock data
+
+def get_text(batch_size, seq_len, device, num_tokens = NUM_TEXT_TOKENS):
+    # captions of random lengths, right padded with the pad token (0)
+
+    text = torch.randint(1, num_tokens, (batch_size, seq_len), device = device)
+    lengths = torch.randint(max(seq_len // 4, 1), seq_len + 1, (batch_size, 1), device = device)
+    text_mask = torch.arange(seq_len, device = device) < lengths
+    return text.masked_fill(~text_mask, 0), text_mask
+
+def get_captions(num_captions, seed = 0, words_per_caption = (5, 20)):
+    rng = random.Random(seed)
+    words = [''.join(rng.choices(string.ascii_lowercase, k = rng.randint(2, 10))) for _ in range(5000)]
+    return [' '.join(rng.choices(words, k = rng.randint(*words_per_caption))) for _ in range(num_captions)]
+
+# per component timing, with forward hooks on the top level modules of CLIP
+# times are exclusive - a component called from within another (the text transformer within MLM) is only counted once, under itself
+
+class ComponentTimer:
+    def __init__(self, clip, device):
+        self.device = device
+        self.times = dict()
+        self.stack = []
+        self.handles = []
+
+        for name in COMPONENTS:
+            try:
+                module = clip.get_submodule(name)
+            except AttributeError:
+                continue
+
+            self.handles.append(module.register_forward_pre_hook(self.pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self.post_hook(name)))
+
+    def pre_hook(self, name):
+        def hook(module, args):
+            sync(self.device)
+            self.stack.append([name, time.perf_counter(), 0.])
+        return hook
+
+    def post_hook(self, name):
+        def hook(module, args, output):
+            sync(self.device)
+            name, start, nested = self.stack.pop()
+            elapsed = time.perf_counter() - start
+
+            self.times[name] = self.times.get(name, 0.) + elapsed - nested
+
+            if len(self.stack) > 0:
+                self.stack[-1][2] += elapsed
+        return hook
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+# clip benchmarks
+
+def benchmark_clip(
+    feature,
+    batch_size,
+    text_seq_len,
+    image_size,
+    patch_size,
+    depth,
+    dim,
+    device,
+    warmup = 2,
+    repeats = 5
+):
+    torch.manual_seed(0)
+
+    clip = CLIP(
+        dim_text = dim,
+        dim_image = dim,
+        dim_latent = dim,
+        num_text_tokens = NUM_TEXT_TOKENS,
+        text_enc_depth = depth,
+        text_seq_len = text_seq_len,
+        text_heads = 8,
+        visual_enc_depth = depth,
+        visual_image_size = image_size,
+        visual_patch_size = patch_size,
+        visual_heads = 8,
+        **FEATURES[feature]
+    ).to(device)
+
+    text, text_mask = get_text(batch_size, text_seq_len, device)
+    images = torch.randn(batch_size, 3, image_size, image_size, device = device)
+
+    def forward():
+        return clip(text, images, text_mask = text_mask, return_loss = True)
+
+    def forward_backward():
+        forward().backward()
+        clip.zero_grad(set_to_none = True)
+
+    forward_time = timed(forward, device, warmup = warmup, repeats = repeats)
+    forward_backward_time = timed(forward_backward, device, warmup = warmup, repeats = repeats)
+
+    reset_peak_memory(device)
+    forward_backward()
+    peak_memory = get_peak_memory(device)
+
+    # share of the forward time spent in each component, the remainder (contrastive loss, projections of extra latents) is reported as other
+
+    timer = ComponentTimer(clip, device)
+    profiled_time = sum(timed(forward, device, warmup = 0, repeats = 1) for _ in range(repeats))
+    timer.remove()
+
+    component_times = {name: t / repeats for name, t in timer.times.items()}
+    component_times['other'] = max(profiled_time / repeats - sum(component_times.values()), 0.)
+
+    return dict(
+        num_parameters = sum(p.numel() for p in clip.parameters()),
+        forward_seconds = forward_time,
+        forward_backward_seconds = forward_backward_time,
+        forward_samples_per_second = batch_size / forward_time,
+        forward_backward_samples_per_second = batch_size / forward_backward_time,
+        peak_memory_bytes = peak_memory,
+        component_seconds = component_times,
+        component_share = {name: t / sum(component_times.values()) for name, t in component_times.items()}
+    )
+
+# micro benchmarks
+
+def benchmark_tokenizer(num_captions = 1000, context_length = 77, warmup = 1, repeats = 5):
+    tokenizer = SimpleTokenizer()
+    captions = get_captions(num_captions)
+    words = sorted(set(word for caption in captions for word in caption.split()))
+
+    def tokenize():
+        tokenizer.tokenize(captions, context_length = context_length, truncate_text = True)
+
+    def tokenize_cold():
+        tokenizer.cache.clear()
+        tokenize()
+
+    def bpe_cold():
+        tokenizer.cache.clear()
+        for word in words:
+            tokenizer.bpe(word)
+
+    device = torch.device('cpu')
+    warm_time = timed(tokenize, device, warmup = warmup, repeats = repeats)
+    cold_time = timed(tokenize_cold, device, warmup = warmup, repeats = repeats)
+    bpe_time = timed(bpe_cold, device, warmup = warmup, repeats = repeats)
+
+    return dict(
+        tokenize_warm_captions_per_second = num_captions / warm_time,
+        tokenize_cold_captions_per_second = num_captions / cold_time,
+        bpe_cold_words_per_second = len(words) / bpe_time
+    )
+
+def benchmark_mlm_masking(batch_size, seq_len, device, warmup = 2, repeats = 5):
+    mlm = MLM(torch.nn.Identity(), dim = 8, num_tokens = NUM_TEXT_TOKENS, random_token_prob = 0.1).to(device)
+    text, _ = get_text(batch_size, seq_len, device)
+
+    seconds = timed(lambda: mlm.get_masked_input_and_labels(text), device, warmup = warmup, repeats = repeats)
+    return dict(seconds = seconds, samples_per_second = batch_size / seconds)
+
+def benchmark_nt_xent_loss(batch_size, dim, device, warmup = 2, repeats = 5):
+    queries = torch.randn(batch_size, dim, device = device, requires_grad = True)
+    keys = torch.randn(batch_size, dim, device = device, requires_grad = True)
+
+    forward_seconds = timed(lambda: nt_xent_loss(queries, keys), device, warmup = warmup, repeats = repeats)
+    forward_backward_seconds = timed(lambda: nt_xent_loss(queries, keys).backward(), device, warmup = warmup, repeats = repeats)
+    return dict(forward_seconds = forward_seconds, forward_backward_seconds = forward_backward_seconds)
+
+# main
+
+def get_environment(device):
+    return dict(
+        python = platform.python_version(),
+        torch = torch.__version__,
+        platform = platform.platform(),
+        processor = platform.processor(),
+        num_threads = torch.get_num_threads(),
+        device = str(device)
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description = 'benchmark CLIP configurations, the tokenizer, MLM masking and the nt-xent loss')
+    parser.add_argument('--features', nargs = '+', default = list(FEATURES.keys()), choices = list(FEATURES.keys()))
+    parser.add_argument('--batch-sizes', nargs = '+', type = int, default = [8, 32])
+    parser.add_argument('--text-seq-lens', nargs = '+', type = int, default = [64])
+    parser.add_argument('--image-sizes', nargs = '+', type = int, default = [64])
+    parser.add_argument('--patch-sizes', nargs = '+', type = int, default = [16])
+    parser.add_argument('--depths', nargs = '+', type = int, default = [2])
+    parser.add_argument('--dim', type = int, default = 256)
+    parser.add_argument('--warmup', type = int, default = 2)
+    parser.add_argument('--repeats', type = int, default = 5)
+    parser.add_argument('--threads', type = int, default = None)
+    parser.add_argument('--device', default = 'cpu')
+    parser.add_argument('--skip-clip', action = 'store_true', help = 'only run the micro benchmarks')
+    parser.add_argument('--skip-micro', action = 'store_true', help = 'only run the CLIP benchmarks')
+    parser.add_argument('--output', default = None, help = 'json lines file to write the results to, defaults to stdout')
+    args = parser.parse_args()
+
+    if exists(args.threads):
+        torch.set_num_threads(args.threads)
+
+    device = torch.device(args.device)
+    out = open(args.output, 'w') if exists(args.output) else sys.stdout
+
+    def write(benchmark, params, metrics):
+        out.write(json.dumps(dict(benchmark = benchmark, params = params, metrics = metrics), sort_keys = True) + '\n')
+        out.flush()
+
+    write('environment', dict(), get_environment(device))
+
+    timing_kwargs = dict(warmup = args.warmup, repeats = args.repeats)
+
+    if not args.skip_clip:
+        grid = itertools.product(args.features, args.batch_sizes, args.text_seq_lens, args.image_sizes, args.patch_sizes, args.depths)
+
+        for feature, batch_size, text_seq_len, image_size, patch_size, depth in grid:
+            params = dict(feature = feature, batch_size = batch_size, text_seq_len = text_seq_len, image_size = image_size, patch_size = patch_size, depth = depth, dim = args.dim)
+            write('clip', params, benchmark_clip(**params, device = device, **timing_kwargs))
+
+    if not args.skip_micro:
+        write('tokenizer', dict(num_captions = 1000, context_length = 77), benchmark_tokenizer(repeats = args.repeats))
+
+        for batch_size, seq_len in itertools.product(args.batch_sizes, args.text_seq_lens):
+            params = dict(batch_size = batch_size, seq_len = seq_len)
+            write('mlm_masking', params, benchmark_mlm_masking(**params, device = device, **timing_kwargs))
+
+        for batch_size in args.batch_sizes:
+            params = dict(batch_size = batch_size, dim = args.dim)
+            write('nt_xent_loss', params, benchmark_nt_xent_loss(**params, device = device, **timing_kwargs))
+
+    if out is not sys.stdout:
+        out.close()
+
+if __name__ == '__main__':
+    main()
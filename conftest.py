@@ -0,0 +1 @@
+# makes pytest put the repository root on sys.path, so `pytest tests` imports the local x_clip without installing it
@@ -18,8 +18,9 @@ setup(
   install_requires=[
     'einops>=0.3',
     'ftfy',
+    'numpy',
     'regex',
-    'torch>=1.6',
+    'torch>=2.0',
     'torchvision'
   ],
   classifiers=[
@@ -0,0 +1,65 @@
+import os
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+from PIL import Image
+
+from x_clip.dataset import TarShardDataset, write_tar_shards
+
+# helpers
+
+class IndexTokenizer:
+    # captions are the sample indices, so the batches tell which samples every rank saw
+
+    def tokenize(self, texts, return_mask = True, **kwargs):
+        text = torch.tensor([[int(t)] for t in texts])
+        return text, torch.ones_like(text).bool()
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+def collect_indices(rank, world_size, port, shards, multiprocessing_context, queue):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank = rank, world_size = world_size)
+
+    dataset = TarShardDataset(shards, batch_size = 4, image_size = 8, tokenizer = IndexTokenizer())
+    dataloader = DataLoader(dataset, batch_size = None, num_workers = 2, multiprocessing_context = multiprocessing_context)
+
+    indices = [i for text, _, _ in dataloader for i in text.flatten().tolist()]
+    queue.put((rank, indices))
+
+    dist.destroy_process_group()
+
+# shards are split across ranks, whatever the start method of the dataloader workers
+
+@pytest.mark.parametrize('multiprocessing_context', ('fork', 'spawn'))
+def test_tar_shards_split_across_ranks(tmp_path, multiprocessing_context):
+    num_samples, world_size = 40, 2
+
+    samples = ((Image.new('RGB', (8, 8)), str(i)) for i in range(num_samples))
+    shards = [str(path) for path in write_tar_shards(samples, tmp_path, samples_per_shard = 5)]
+
+    ctx = mp.get_context('spawn')
+    queue = ctx.SimpleQueue()
+    port = get_free_port()
+
+    processes = [ctx.Process(target = collect_indices, args = (rank, world_size, port, shards, multiprocessing_context, queue)) for rank in range(world_size)]
+
+    for process in processes:
+        process.start()
+
+    results = dict(queue.get() for _ in range(world_size))
+
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    assert len(results[0]) == len(results[1]) == num_samples // world_size
+    assert sorted(results[0] + results[1]) == list(range(num_samples))
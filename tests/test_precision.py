@@ -0,0 +1,89 @@
+import pytest
+import torch
+
+from x_clip import CLIP
+from x_clip.x_clip import einsum_attention, chunked_attention
+
+# helpers
+
+def get_clip(**kwargs):
+    return CLIP(
+        dim_text = 64,
+        dim_image = 64,
+        dim_latent = 32,
+        num_text_tokens = 1000,
+        text_enc_depth = 2,
+        text_seq_len = 16,
+        text_heads = 4,
+        visual_enc_depth = 2,
+        visual_image_size = 32,
+        visual_patch_size = 8,
+        visual_heads = 4,
+        attn_chunk_size = 4,
+        **kwargs
+    )
+
+def get_data(batch = 4, seq_len = 16, image_size = 32):
+    text = torch.randint(1, 1000, (batch, seq_len))
+    text_mask = torch.ones_like(text).bool()
+    text_mask[:, (seq_len // 2):] = torch.rand(batch, seq_len - seq_len // 2) > 0.5
+    images = torch.randn(batch, 3, image_size, image_size)
+    return text, images, text_mask
+
+def loss_and_grads(clip, text, images, text_mask):
+    clip.zero_grad()
+    loss = clip(text, images, text_mask = text_mask, return_loss = True)
+    loss.backward()
+    grads = torch.cat([p.grad.flatten() for p in clip.parameters() if p.grad is not None])
+    return loss.detach(), grads
+
+# mixed precision matches fp32
+
+@pytest.mark.parametrize('precision', ('bf16', 'fp16'))
+@pytest.mark.parametrize('attn_backend', ('einsum', 'sdpa', 'chunked'))
+@pytest.mark.parametrize('fine_grained', (False, True))
+def test_mixed_precision_matches_fp32(precision, attn_backend, fine_grained):
+    torch.manual_seed(0)
+
+    kwargs = dict(
+        attn_backend = attn_backend,
+        use_all_token_embeds = fine_grained,
+        decoupled_contrastive_learning = fine_grained
+    )
+
+    clip = get_clip(**kwargs)
+    mixed_clip = get_clip(**kwargs, precision = precision)
+    mixed_clip.load_state_dict(clip.state_dict())
+
+    data = get_data()
+
+    loss, grads = loss_and_grads(clip, *data)
+    mixed_loss, mixed_grads = loss_and_grads(mixed_clip, *data)
+
+    # losses and gradients stay in float32, only the encoders run in half precision
+
+    assert mixed_loss.dtype == torch.float32
+    assert mixed_grads.dtype == torch.float32
+
+    assert torch.allclose(mixed_loss, loss, rtol = 2e-2, atol = 2e-2)
+    assert torch.cosine_similarity(mixed_grads, grads, dim = 0) > 0.99
+    assert (mixed_grads - grads).norm() / grads.norm() < 0.1
+
+# float64 is not reduced to float32
+
+@pytest.mark.parametrize('attn_fn', (einsum_attention, lambda *args, **kwargs: chunked_attention(*args, chunk_size = 8, **kwargs)))
+def test_attention_float64_is_exact(attn_fn):
+    torch.manual_seed(0)
+    q, k, v = (torch.randn(2, 2, 37, 16, dtype = torch.float64) for _ in range(3))
+
+    mask = torch.rand(2, 37) > 0.2
+    mask[:, 0] = True
+
+    sim = (q @ k.transpose(-1, -2)) * (16 ** -0.5)
+    sim = sim.masked_fill(~mask[:, None, None, :], -torch.finfo(sim.dtype).max)
+    expected = sim.softmax(dim = -1) @ v
+
+    out = attn_fn(q, k, v, mask = mask)
+
+    assert out.dtype == torch.float64
+    assert torch.allclose(out, expected, atol = 1e-12)
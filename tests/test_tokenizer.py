@@ -0,0 +1,13 @@
+from x_clip.tokenizer import SimpleTokenizer
+
+# the bpe cache counters only count tokens that go through the cache
+
+def test_bpe_cache_counters():
+    tokenizer = SimpleTokenizer()
+
+    tokenizer.encode('1 2 3 , . ! 1 2 3 , . !')
+    assert tokenizer.cache_info()['hits'] == tokenizer.cache_info()['misses'] == 0
+
+    tokenizer.encode('a cat and a dog, a cat and a dog')
+    info = tokenizer.cache_info()
+    assert (info['hits'], info['misses'], info['size']) == (3, 3, 3)
@@ -0,0 +1,30 @@
+from x_clip import CLIP
+
+# helpers
+
+def get_clip(**kwargs):
+    return CLIP(
+        dim_text = 64,
+        dim_image = 64,
+        dim_latent = 32,
+        num_text_tokens = 1000,
+        text_enc_depth = 1,
+        text_seq_len = 16,
+        text_heads = 2,
+        visual_enc_depth = 1,
+        visual_image_size = 32,
+        visual_patch_size = 8,
+        visual_heads = 2,
+        **kwargs
+    )
+
+# checkpoints from before the extra latent projections became optional still load strictly
+
+def test_load_checkpoint_with_unused_extra_latents():
+    state_dict = get_clip(extra_latent_projection = True).state_dict()
+    assert any('latent_extra' in key for key in state_dict)
+
+    clip = get_clip()
+    clip.load_state_dict(state_dict)
+
+    assert not any('latent_extra' in key for key in clip.state_dict())
@@ -0,0 +1,155 @@
+import json
+import math
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset
+
+from x_clip.tokenizer import get_tokenizer
+
+# captions tokenized once, stored as one flat uint16 array of all tokens, with an int64 offsets index of n + 1 entries
+# the vocabulary (49408) fits in uint16, so a caption costs 2 bytes per token, instead of 8 bytes per token of context length
+
+TOKENS_FILE = 'tokens.bin'
+OFFSETS_FILE = 'offsets.npy'
+META_FILE = 'meta.json'
+
+# helper functions
+
+def exists(val):
+    return val is not None
+
+def chunked(iterable, chunk_size):
+    chunk = []
+
+    for item in iterable:
+        chunk.append(item)
+
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if len(chunk) > 0:
+        yield chunk
+
+# building
+
+def build_tokenized_captions(
+    captions,
+    path,
+    tokenizer = None,
+    num_workers = 0,
+    chunk_size = 1024
+):
+    # captions is any iterable of strings, streamed through in chunks, so the corpus never has to fit in memory
+
+    tokenizer = tokenizer if exists(tokenizer) else get_tokenizer()
+    assert tokenizer.vocab_size <= 2 ** 16, 'vocabulary must fit in uint16'
+
+    path = Path(path)
+    path.mkdir(parents = True, exist_ok = True)
+
+    offsets = [0]
+    chunk_captions = chunk_size * max(num_workers, 1)
+
+    with open(path / TOKENS_FILE, 'wb') as f:
+        for captions_chunk in chunked(captions, chunk_captions):
+            for tokens in tokenizer.encode_batch(captions_chunk, num_workers = num_workers, chunk_size = chunk_size):
+                f.write(np.asarray(tokens, dtype = np.uint16).tobytes())
+                offsets.append(offsets[-1] + len(tokens))
+
+    np.save(str(path / OFFSETS_FILE), np.asarray(offsets, dtype = np.int64))
+
+    meta = dict(num_captions = len(offsets) - 1, num_tokens = offsets[-1], vocab_size = tokenizer.vocab_size)
+    (path / META_FILE).write_text(json.dumps(meta))
+
+    return TokenizedCaptions(path)
+
+# reading
+
+class TokenizedCaptions(Dataset):
+    def __init__(self, path):
+        # rows are zero copy uint16 views into the memory mapped tokens
+        # get_batch pads a batch of rows on the fly into the (text, text_mask) expected by CLIP
+
+        self.path = Path(path)
+        self.meta = json.loads((self.path / META_FILE).read_text())
+
+        self.offsets = np.load(str(self.path / OFFSETS_FILE), mmap_mode = 'r')
+        num_tokens = self.meta['num_tokens']
+
+        # an empty file cannot be memory mapped
+
+        self.tokens = np.memmap(str(self.path / TOKENS_FILE), dtype = np.uint16, mode = 'r', shape = (num_tokens,)) if num_tokens > 0 else np.zeros((0,), dtype = np.uint16)
+
+    def __len__(self):
+        return self.meta['num_captions']
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.tokens[start:end]
+
+    @property
+    def lengths(self):
+        # number of tokens per caption, for the LengthBucketBatchSampler
+        return np.diff(self.offsets)
+
+    def get_batch(
+        self,
+        indices,
+        context_length = 256,
+        truncate_text = True,
+        pad_to_longest = False,
+        pad_to_multiple_of = None
+    ):
+        # same padding and truncation semantics as SimpleTokenizer.tokenize(..., return_mask = True)
+
+        indices = np.asarray(indices, dtype = np.int64)
+        lengths = self.offsets[indices + 1] - self.offsets[indices]
+
+        if not truncate_text and (lengths > context_length).any():
+            raise RuntimeError(f'caption {indices[lengths.argmax()]} is too long for context length {context_length}')
+
+        lengths = np.minimum(lengths, context_length)
+
+        seq_len = context_length
+
+        if pad_to_longest:
+            seq_len = int(lengths.max(initial = 1))
+
+            if exists(pad_to_multiple_of):
+                seq_len = math.ceil(seq_len / pad_to_multiple_of) * pad_to_multiple_of
+
+            seq_len = min(seq_len, context_length)
+
+        text = np.zeros((len(indices), seq_len), dtype = np.int64)
+
+        for row, (index, length) in enumerate(zip(indices, lengths)):
+            start = self.offsets[index]
+            text[row, :length] = self.tokens[start:(start + length)]
+
+        text = torch.from_numpy(text)
+        text_mask = torch.arange(seq_len) < torch.from_numpy(lengths)[:, None]
+        return text, text_mask
+
+# command line tool, tokenizing a text file of one caption per line
+
+def main():
+    parser = argparse.ArgumentParser(description = 'tokenize a file of one caption per line into a memory mapped uint16 caption corpus')
+    parser.add_argument('captions', help = 'text file with one caption per line')
+    parser.add_argument('output', help = 'directory to write the tokenized captions to')
+    parser.add_argument('--num-workers', type = int, default = 0)
+    parser.add_argument('--chunk-size', type = int, default = 1024)
+    args = parser.parse_args()
+
+    with open(args.captions, encoding = 'utf-8') as f:
+        captions = (line.rstrip('\n') for line in f)
+        corpus = build_tokenized_captions(captions, args.output, num_workers = args.num_workers, chunk_size = args.chunk_size)
+
+    print(f'tokenized {len(corpus)} captions into {corpus.meta["num_tokens"]} tokens at {args.output}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+import io
+import os
+import glob
+import random
+import tarfile
+from pathlib import Path
+
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+import torchvision.transforms as T
+from PIL import Image
+
+from x_clip.tokenizer import get_tokenizer
+from x_clip.distributed import is_distributed, get_rank, get_world_size
+
+# constants
+
+IMAGE_EXTENSIONS = ('jpg', 'jpeg', 'png', 'webp')
+CAPTION_EXTENSIONS = ('txt',)
+
+# helper functions
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    return val if exists(val) else d
+
+def get_default_transform(image_size):
+    return T.Compose([
+        T.Resize(image_size),
+        T.CenterCrop(image_size),
+        T.ToTensor()
+    ])
+
+def get_rank_and_world_size():
+    # looked up in the main process, as dataloader workers started with spawn or forkserver have no process group
+    # falls back to the environment variables set by torchrun, for datasets constructed before the process group
+
+    if is_distributed():
+        return get_rank(), get_world_size()
+
+    return int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+
+def expand_shards(shards):
+    # either a list of shard paths, or a glob pattern such as './shards/train-*.tar'
+
+    if isinstance(shards, (str, Path)):
+        shards = sorted(glob.glob(str(shards)))
+
+    shards = [str(shard) for shard in shards]
+    assert len(shards) > 0, 'no tar shards were found'
+    return shards
+
+def split_key(name):
+    # webdataset convention - files of one sample share the key up to the first dot of the basename, 'dir/000001.jpg' -> ('dir/000001', 'jpg')
+
+    dirname, _, basename = name.rpartition('/')
+    key, _, extension = basename.partition('.')
+    return (f'{dirname}/{key}' if dirname else key), extension.lower()
+
+# reading samples out of tar shards, streamed sequentially
+
+def iter_tar_samples(path):
+    # yields (key, image bytes, caption) of consecutive members sharing the same key, skipping samples missing either
+
+    key, image, caption = None, None, None
+
+    with tarfile.open(path, mode = 'r|*') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+
+            member_key, extension = split_key(member.name)
+
+            if member_key != key:
+                if exists(image) and exists(caption):
+                    yield key, image, caption
+
+                key, image, caption = member_key, None, None
+
+            if extension in IMAGE_EXTENSIONS:
+                image = tar.extractfile(member).read()
+            elif extension in CAPTION_EXTENSIONS:
+                caption = tar.extractfile(member).read().decode('utf-8').strip()
+
+    if exists(image) and exists(caption):
+        yield key, image, caption
+
+def shuffle_buffer(iterator, buffer_size, rng):
+    # bounded shuffle - a random sample of the buffer is emitted and replaced by the next sample streamed in
+
+    if buffer_size <= 1:
+        yield from iterator
+        return
+
+    buffer = []
+
+    for sample in iterator:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = sample
+
+    rng.shuffle(buffer)
+    yield from buffer
+
+# writing shards, for converting existing datasets and for generating shards locally
+
+def write_tar_shards(
+    samples,
+    path,
+    samples_per_shard = 1000,
+    image_format = 'jpg'
+):
+    # samples is an iterable of (image, caption), with the image either a PIL image or already encoded bytes
+    # path is a directory, shards are written as shard-00000.tar, shard-00001.tar, ... and their paths returned
+
+    path = Path(path)
+    path.mkdir(parents = True, exist_ok = True)
+
+    shard_paths = []
+    tar = None
+
+    def add_file(name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    for index, (image, caption) in enumerate(samples):
+        if index % samples_per_shard == 0:
+            if exists(tar):
+                tar.close()
+
+            shard_paths.append(path / f'shard-{len(shard_paths):05d}.tar')
+            tar = tarfile.open(shard_paths[-1], mode = 'w')
+
+        if isinstance(image, Image.Image):
+            buffer = io.BytesIO()
+            image.save(buffer, format = 'jpeg' if image_format == 'jpg' else image_format)
+            image = buffer.getvalue()
+
+        key = f'{index:09d}'
+        add_file(f'{key}.{image_format}', image)
+        add_file(f'{key}.txt', caption.encode('utf-8'))
+
+    if exists(tar):
+        tar.close()
+
+    return shard_paths
+
+# main class
+
+class TarShardDataset(IterableDataset):
+    def __init__(
+        self,
+        shards,
+        batch_size,
+        image_size = 256,
+        context_length = 256,
+        image_transform = None,
+        tokenizer = None,
+        truncate_text = True,
+        pad_to_longest = False,
+        pad_to_multiple_of = None,
+        shuffle_shards = True,
+        shuffle_buffer_size = 1000,
+        drop_last = False,
+        seed = 0
+    ):
+        # streams (image, caption) pairs out of tar shards and emits ready to use (text, images, text_mask) batches
+        # shards are split across distributed processes and then dataloader workers, so use with DataLoader(dataset, batch_size = None)
+        # decoding and tokenization happen within the workers, with the default tokenizer only constructed there
+
+        super().__init__()
+        self.shards = expand_shards(shards)
+        self.batch_size = batch_size
+        self.context_length = context_length
+        self.image_transform = default(image_transform, get_default_transform(image_size))
+        self.tokenizer = tokenizer
+
+        self.tokenize_kwargs = dict(
+            context_length = context_length,
+            truncate_text = truncate_text,
+            pad_to_longest = pad_to_longest,
+            pad_to_multiple_of = pad_to_multiple_of,
+            return_mask = True
+        )
+
+        self.shuffle_shards = shuffle_shards
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        self.rank, self.world_size = get_rank_and_world_size()
+
+    def set_epoch(self, epoch):
+        # reshuffles the shards and samples, only seen by the workers if they are not persistent
+        # also refreshes the rank and world size, in case the dataset was constructed before the process group
+        self.epoch = epoch
+        self.rank, self.world_size = get_rank_and_world_size()
+
+    def get_shards(self):
+        # every process shuffles the shards identically, then takes its own slice, which is further sliced per worker
+
+        shards = list(self.shards)
+
+        if self.shuffle_shards:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if exists(worker_info) else (0, 1)
+
+        split_index = self.rank * num_workers + worker_id
+        num_splits = self.world_size * num_workers
+        return shards[split_index::num_splits], split_index
+
+    def iter_samples(self, shards):
+        for shard in shards:
+            yield from iter_tar_samples(shard)
+
+    def collate(self, samples):
+        images = torch.stack([self.image_transform(Image.open(io.BytesIO(image)).convert('RGB')) for _, image, _ in samples])
+
+        tokenizer = self.tokenizer if exists(self.tokenizer) else get_tokenizer()
+        text, text_mask = tokenizer.tokenize([caption for _, _, caption in samples], **self.tokenize_kwargs)
+
+        return text, images, text_mask
+
+    def __iter__(self):
+        shards, split_index = self.get_shards()
+        rng = random.Random(hash((self.seed, self.epoch, split_index)))
+
+        samples = shuffle_buffer(self.iter_samples(shards), self.shuffle_buffer_size, rng)
+
+        batch = []
+
+        for sample in samples:
+            batch.append(sample)
+
+            if len(batch) == self.batch_size:
+                yield self.collate(batch)
+                batch = []
+
+        if len(batch) > 0 and not self.drop_last:
+            yield self.collate(batch)
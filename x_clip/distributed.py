@@ -0,0 +1,65 @@
+import torch
+from torch.autograd import Function
+import torch.distributed as dist
+
+# helpers
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def pad_batch_to(t, length):
+    if t.shape[0] == length:
+        return t
+    padding = t.new_zeros((length - t.shape[0], *t.shape[1:]))
+    return torch.cat((t, padding), dim = 0)
+
+def gather_sizes(t):
+    # batch sizes across all processes, so uneven final batches can still be gathered
+
+    size = torch.tensor([t.shape[0]], device = t.device, dtype = torch.long)
+    sizes = [torch.empty_like(size) for _ in range(get_world_size())]
+    dist.all_gather(sizes, size)
+    return [s.item() for s in sizes]
+
+def all_gather_batch(t, sizes):
+    max_size = max(sizes)
+    padded = pad_batch_to(t, max_size).contiguous()
+
+    gathered = [torch.empty_like(padded) for _ in sizes]
+    dist.all_gather(gathered, padded)
+
+    return torch.cat([g[:size] for g, size in zip(gathered, sizes)], dim = 0)
+
+# all gather that passes gradients back to the process the tensor came from
+
+class AllGather(Function):
+    @staticmethod
+    def forward(ctx, t, sizes):
+        ctx.sizes = sizes
+        ctx.rank = get_rank()
+        return all_gather_batch(t, sizes)
+
+    @staticmethod
+    def backward(ctx, grads):
+        # every process holds gradients for all gathered rows, as each computes its own slice of the global logits
+        # sum them up across processes, then take back the rows belonging to this process
+
+        grads = grads.contiguous()
+        dist.all_reduce(grads)
+
+        start = sum(ctx.sizes[:ctx.rank])
+        return grads[start:(start + ctx.sizes[ctx.rank])], None
+
+def all_gather_with_grad(t, sizes):
+    return AllGather.apply(t, sizes)
+
+def all_gather_mask(mask, sizes):
+    # not all backends (gloo) support gathering boolean tensors
+
+    return all_gather_batch(mask.to(torch.uint8), sizes).bool()
@@ -0,0 +1,174 @@
+from contextlib import contextmanager
+
+import torch
+from torch import nn
+
+# helper functions
+
+@contextmanager
+def eval_mode(model):
+    was_training = model.training
+    model.eval()
+    try:
+        yield
+    finally:
+        model.train(was_training)
+
+@contextmanager
+def padded_text(clip):
+    # the unpadded text path has data dependent shapes, which cannot be exported - the padded path gives the same latents
+
+    text_transformer = clip.text_transformer
+    unpad = getattr(text_transformer, 'unpad', False)
+    text_transformer.unpad = False
+    try:
+        yield
+    finally:
+        text_transformer.unpad = unpad
+
+# the text and image towers of CLIP as standalone modules, (tokens, mask) -> latents and (pixels) -> latents
+
+class TextEncoder(nn.Module):
+    def __init__(self, clip, return_extra = False):
+        super().__init__()
+        self.clip = clip
+        self.return_extra = return_extra
+
+    def forward(self, text, text_mask):
+        text_latents, text_latents_extra = self.clip.get_text_latents(text, text_mask)
+        return text_latents_extra if self.return_extra else text_latents
+
+class ImageEncoder(nn.Module):
+    def __init__(self, clip, return_extra = False):
+        super().__init__()
+        self.clip = clip
+        self.return_extra = return_extra
+
+    def forward(self, image):
+        image_latents, image_latents_extra = self.clip.get_image_latents(image)
+        return image_latents_extra if self.return_extra else image_latents
+
+# example inputs
+
+def get_example_text(clip, batch_size, seq_len):
+    device = next(clip.parameters()).device
+    num_tokens = clip.text_transformer.token_emb.num_embeddings
+
+    text = torch.randint(0, num_tokens, (batch_size, seq_len), device = device)
+    text_mask = torch.ones((batch_size, seq_len), device = device, dtype = torch.bool)
+    text_mask[0, (seq_len // 2):] = False
+    return text, text_mask
+
+def get_example_image(clip, batch_size, image_size, channels = 3):
+    device = next(clip.parameters()).device
+    return torch.randn((batch_size, channels, image_size, image_size), device = device)
+
+# exporting
+# the traced graphs have dynamic batch (and for text, sequence) axes, and are checked against eager CLIP on differently shaped inputs
+# the 'chunked' attention backend loops over the keys in python, so a traced graph would bake in the sequence length - use 'einsum' or 'sdpa' for exporting
+
+TEXT_DYNAMIC_AXES = dict(
+    text = {0: 'batch', 1: 'seq'},
+    text_mask = {0: 'batch', 1: 'seq'},
+    latents = {0: 'batch'}
+)
+
+IMAGE_DYNAMIC_AXES = dict(
+    image = {0: 'batch'},
+    latents = {0: 'batch'}
+)
+
+def export_text_encoder(
+    clip,
+    path,
+    format = 'torchscript',     # either 'torchscript' or 'onnx'
+    seq_len = 16,
+    return_extra = False,
+    opset_version = 18,
+    check = True,
+    atol = 1e-4
+):
+    assert format in ('torchscript', 'onnx'), 'format must be either torchscript or onnx'
+
+    encoder = TextEncoder(clip, return_extra = return_extra)
+    inputs = get_example_text(clip, 2, seq_len)
+
+    with eval_mode(clip), padded_text(clip), torch.no_grad():
+        if format == 'torchscript':
+            torch.jit.trace(encoder, inputs, check_trace = False).save(str(path))
+        else:
+            torch.onnx.export(encoder, inputs, str(path), input_names = ['text', 'text_mask'], output_names = ['latents'], dynamic_axes = TEXT_DYNAMIC_AXES, opset_version = opset_version)
+
+    if check:
+        check_text_encoder(clip, path, format = format, seq_len = max(seq_len - 3, 1), return_extra = return_extra, atol = atol)
+
+    return path
+
+def export_image_encoder(
+    clip,
+    path,
+    format = 'torchscript',
+    image_size = 256,
+    channels = 3,
+    return_extra = False,
+    opset_version = 18,
+    check = True,
+    atol = 1e-4
+):
+    # image size is fixed by the positional embeddings of the vision transformer, only the batch axis is dynamic
+
+    assert format in ('torchscript', 'onnx'), 'format must be either torchscript or onnx'
+
+    encoder = ImageEncoder(clip, return_extra = return_extra)
+    inputs = (get_example_image(clip, 2, image_size, channels),)
+
+    with eval_mode(clip), torch.no_grad():
+        if format == 'torchscript':
+            torch.jit.trace(encoder, inputs, check_trace = False).save(str(path))
+        else:
+            torch.onnx.export(encoder, inputs, str(path), input_names = ['image'], output_names = ['latents'], dynamic_axes = IMAGE_DYNAMIC_AXES, opset_version = opset_version)
+
+    if check:
+        check_image_encoder(clip, path, format = format, image_size = image_size, channels = channels, return_extra = return_extra, atol = atol)
+
+    return path
+
+# parity checks against eager CLIP
+
+def run_exported(path, format, inputs):
+    if format == 'torchscript':
+        module = torch.jit.load(str(path), map_location = inputs[0].device)
+        return module(*inputs)
+
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError('onnxruntime must be installed to check the exported onnx graph - pip install onnxruntime')
+
+    session = onnxruntime.InferenceSession(str(path))
+    input_names = [node.name for node in session.get_inputs()]
+    out, = session.run(None, {name: t.cpu().numpy() for name, t in zip(input_names, inputs)})
+    return torch.from_numpy(out)
+
+def assert_parity(exported, eager, atol):
+    max_diff = (exported.float().cpu() - eager.float().cpu()).abs().amax().item()
+    assert max_diff <= atol, f'exported encoder deviates from eager CLIP by {max_diff}, which is greater than the tolerance of {atol}'
+    return max_diff
+
+@torch.no_grad()
+def check_text_encoder(clip, path, format = 'torchscript', batch_size = 3, seq_len = 13, return_extra = False, atol = 1e-4):
+    inputs = get_example_text(clip, batch_size, seq_len)
+
+    with eval_mode(clip):
+        eager = TextEncoder(clip, return_extra = return_extra)(*inputs)
+
+    return assert_parity(run_exported(path, format, inputs), eager, atol)
+
+@torch.no_grad()
+def check_image_encoder(clip, path, format = 'torchscript', batch_size = 3, image_size = 256, channels = 3, return_extra = False, atol = 1e-4):
+    inputs = (get_example_image(clip, batch_size, image_size, channels),)
+
+    with eval_mode(clip):
+        eager = ImageEncoder(clip, return_extra = return_extra)(*inputs)
+
+    return assert_parity(run_exported(path, format, inputs), eager, atol)
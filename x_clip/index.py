@@ -0,0 +1,296 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+# helper functions
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    return val if exists(val) else d
+
+def l2norm(t):
+    return F.normalize(t, dim = -1, p = 2)
+
+def merge_topk(scores, indices, new_scores, new_indices, k):
+    scores = torch.cat((scores, new_scores), dim = -1)
+    indices = torch.cat((indices, new_indices), dim = -1)
+
+    scores, topk_indices = scores.topk(min(k, scores.shape[-1]), dim = -1)
+    return scores, indices.gather(-1, topk_indices)
+
+def kmeans(x, num_clusters, num_iters = 20, chunk_size = 2 ** 16, generator = None):
+    # spherical k-means, as the latents are compared by inner product
+
+    n = x.shape[0]
+    assert n >= num_clusters, f'need at least {num_clusters} vectors to train {num_clusters} clusters, but only {n} were given'
+
+    centroids = x[torch.randperm(n, generator = generator)[:num_clusters]].clone()
+
+    for _ in range(num_iters):
+        assignments = assign_to_centroids(x, centroids, chunk_size = chunk_size)
+
+        new_centroids = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        counts = torch.bincount(assignments, minlength = num_clusters)
+
+        # reseed empty clusters with random vectors
+
+        empty = counts == 0
+        if empty.any():
+            new_centroids[empty] = x[torch.randint(0, n, (int(empty.sum()),), generator = generator)]
+
+        centroids = l2norm(new_centroids)
+
+    return centroids
+
+def assign_to_centroids(x, centroids, chunk_size = 2 ** 16):
+    return torch.cat([(chunk @ centroids.t()).argmax(dim = -1) for chunk in x.split(chunk_size)])
+
+# main class
+
+class LatentIndex:
+    def __init__(
+        self,
+        path,
+        dim,
+        dtype = 'float16',
+        shard_size = 2 ** 20,
+        nprobe = 8
+    ):
+        # stores l2-normalized latents in memory-mapped shards of shard_size vectors on disk
+        # searched exactly by chunked matmuls, or approximately with an inverted file (IVF) once train_ivf is called
+
+        assert dtype in ('float16', 'float32'), 'dtype must be either float16 or float32'
+
+        self.path = Path(path)
+        self.path.mkdir(parents = True, exist_ok = True)
+
+        self.dim = dim
+        self.dtype = dtype
+        self.shard_size = shard_size
+        self.nprobe = nprobe
+
+        self.count = 0
+        self.shards = []
+
+        self.centroids = None
+        self.assignments = np.zeros((0,), dtype = np.int64)
+        self.pending_assignments = []
+        self.list_order = None
+        self.list_offsets = None
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def is_ivf_trained(self):
+        return exists(self.centroids)
+
+    @property
+    def num_lists(self):
+        return self.centroids.shape[0] if self.is_ivf_trained else 0
+
+    def shard_path(self, shard_index):
+        return self.path / f'shard_{shard_index:05d}.npy'
+
+    def open_shard(self, shard_index, mode = 'r+'):
+        shard_kwargs = dict(dtype = self.dtype, shape = (self.shard_size, self.dim)) if mode == 'w+' else dict()
+        return np.lib.format.open_memmap(str(self.shard_path(shard_index)), mode = mode, **shard_kwargs)
+
+    # adding
+
+    def add(self, latents):
+        latents = l2norm(torch.as_tensor(latents).detach().float().cpu())
+        assert latents.ndim == 2 and latents.shape[-1] == self.dim, f'latents must be of shape (batch, {self.dim})'
+
+        arr = latents.numpy().astype(self.dtype)
+        ids = torch.arange(self.count, self.count + arr.shape[0])
+
+        written = 0
+        while written < arr.shape[0]:
+            shard_index, offset = divmod(self.count, self.shard_size)
+
+            if shard_index == len(self.shards):
+                self.shards.append(self.open_shard(shard_index, mode = 'w+'))
+
+            num_rows = min(self.shard_size - offset, arr.shape[0] - written)
+            self.shards[shard_index][offset:(offset + num_rows)] = arr[written:(written + num_rows)]
+
+            written += num_rows
+            self.count += num_rows
+
+        # new vectors are assigned to their inverted lists, if the coarse quantizer is already trained
+        # the lists themselves are only rebuilt once, on the next search or save, so streaming in many small batches stays cheap
+
+        if self.is_ivf_trained:
+            self.pending_assignments.append(assign_to_centroids(latents, self.centroids).numpy())
+
+        return ids
+
+    # reading
+
+    def iter_chunks(self, chunk_size = 2 ** 16):
+        for shard_index, shard in enumerate(self.shards):
+            shard_start = shard_index * self.shard_size
+            shard_count = min(self.shard_size, self.count - shard_start)
+
+            for start in range(0, shard_count, chunk_size):
+                end = min(start + chunk_size, shard_count)
+                yield shard_start + start, torch.from_numpy(np.ascontiguousarray(shard[start:end])).float()
+
+    def get(self, ids):
+        ids = np.asarray(ids, dtype = np.int64)
+        out = np.empty((ids.shape[0], self.dim), dtype = self.dtype)
+
+        shard_indices, rows = np.divmod(ids, self.shard_size)
+
+        for shard_index in np.unique(shard_indices):
+            mask = shard_indices == shard_index
+            out[mask] = self.shards[shard_index][rows[mask]]
+
+        return torch.from_numpy(out).float()
+
+    # searching
+
+    @torch.no_grad()
+    def search(
+        self,
+        queries,
+        k = 10,
+        exact = None,
+        nprobe = None,
+        chunk_size = 2 ** 16
+    ):
+        # returns (scores, ids) of the top k inner products for each query, ids are -1 where fewer than k vectors were found
+        # defaults to exact search until an IVF coarse quantizer is trained
+
+        queries = l2norm(torch.as_tensor(queries).detach().float().cpu())
+        exact = default(exact, not self.is_ivf_trained)
+
+        if exact:
+            return self.search_exact(queries, k = k, chunk_size = chunk_size)
+
+        assert self.is_ivf_trained, 'train_ivf must be called before searching approximately'
+        return self.search_ivf(queries, k = k, nprobe = default(nprobe, self.nprobe))
+
+    def init_topk(self, queries, k):
+        num_queries = queries.shape[0]
+        return torch.full((num_queries, k), -float('inf')), torch.full((num_queries, k), -1, dtype = torch.long)
+
+    def search_exact(self, queries, k = 10, chunk_size = 2 ** 16):
+        scores, indices = self.init_topk(queries, k)
+
+        for start, chunk in self.iter_chunks(chunk_size):
+            sim = queries @ chunk.t()
+            chunk_scores, chunk_indices = sim.topk(min(k, sim.shape[-1]), dim = -1)
+            scores, indices = merge_topk(scores, indices, chunk_scores, chunk_indices + start, k)
+
+        return scores, indices
+
+    def search_ivf(self, queries, k = 10, nprobe = 8):
+        self.update_inverted_lists()
+        scores, indices = self.init_topk(queries, k)
+
+        nprobe = min(nprobe, self.num_lists)
+        probes = (queries @ self.centroids.t()).topk(nprobe, dim = -1).indices
+
+        # visit each probed inverted list once, scoring it against all queries that probe it
+
+        for list_id in probes.unique().tolist():
+            start, end = self.list_offsets[list_id], self.list_offsets[list_id + 1]
+
+            if start == end:
+                continue
+
+            ids = self.list_order[start:end]
+            query_ids = (probes == list_id).any(dim = -1).nonzero(as_tuple = True)[0]
+
+            sim = queries[query_ids] @ self.get(ids).t()
+            list_scores, list_indices = sim.topk(min(k, sim.shape[-1]), dim = -1)
+            list_indices = torch.from_numpy(ids)[list_indices]
+
+            scores[query_ids], indices[query_ids] = merge_topk(scores[query_ids], indices[query_ids], list_scores, list_indices, k)
+
+        return scores, indices
+
+    # inverted file
+
+    @torch.no_grad()
+    def train_ivf(
+        self,
+        num_lists,
+        num_iters = 20,
+        sample_size = None,
+        seed = None
+    ):
+        generator = torch.Generator().manual_seed(seed) if exists(seed) else None
+
+        sample_size = min(default(sample_size, num_lists * 256), self.count)
+        sample_ids = torch.randperm(self.count, generator = generator)[:sample_size].sort().values
+        sample = self.get(sample_ids.numpy())
+
+        self.centroids = kmeans(sample, num_lists, num_iters = num_iters, generator = generator)
+
+        self.assignments = torch.cat([assign_to_centroids(chunk, self.centroids) for _, chunk in self.iter_chunks()]).numpy()
+        self.pending_assignments = []
+        self.build_inverted_lists()
+
+    def update_inverted_lists(self):
+        if len(self.pending_assignments) == 0:
+            return
+
+        self.assignments = np.concatenate((self.assignments, *self.pending_assignments))
+        self.pending_assignments = []
+        self.build_inverted_lists()
+
+    def build_inverted_lists(self):
+        self.list_order = np.argsort(self.assignments, kind = 'stable')
+        counts = np.bincount(self.assignments, minlength = self.num_lists)
+        self.list_offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    # saving and loading
+
+    def save(self):
+        self.update_inverted_lists()
+
+        for shard in self.shards:
+            shard.flush()
+
+        meta = dict(
+            dim = self.dim,
+            dtype = self.dtype,
+            shard_size = self.shard_size,
+            nprobe = self.nprobe,
+            count = self.count,
+            num_shards = len(self.shards)
+        )
+
+        (self.path / 'meta.json').write_text(json.dumps(meta))
+
+        if self.is_ivf_trained:
+            np.save(str(self.path / 'centroids.npy'), self.centroids.numpy())
+            np.save(str(self.path / 'assignments.npy'), self.assignments)
+
+    @classmethod
+    def load(cls, path):
+        path = Path(path)
+        meta = json.loads((path / 'meta.json').read_text())
+        num_shards, count = meta.pop('num_shards'), meta.pop('count')
+
+        index = cls(path, **meta)
+        index.count = count
+        index.shards = [index.open_shard(shard_index) for shard_index in range(num_shards)]
+
+        centroids_path = path / 'centroids.npy'
+
+        if centroids_path.exists():
+            index.centroids = torch.from_numpy(np.load(str(centroids_path)))
+            index.assignments = np.load(str(path / 'assignments.npy'))
+            index.build_inverted_lists()
+
+        return index
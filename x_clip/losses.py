@@ -0,0 +1,78 @@
+import torch
+from torch.autograd import Function
+
+# helper functions
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    return val if exists(val) else d
+
+def upcast(t):
+    # half types are upcast to float32, float32 and float64 are kept as is
+    return t.to(torch.promote_types(t.dtype, torch.float32))
+
+# fused contrastive loss
+# InfoNCE (or DCL, with positives removed from the denominator) as logsumexp(logits) - positive logit, accumulated in (at least) float32 over blocks of rows
+# the softmax is recomputed blockwise on backward rather than stored, so the only full sized tensors are the logits and their gradient
+
+class FusedContrastiveLoss(Function):
+    @staticmethod
+    def forward(ctx, logits, rank_offset, decoupled, block_size):
+        b, device = logits.shape[0], logits.device
+        block_size = default(block_size, b)
+
+        targets = torch.arange(b, device = device) + rank_offset
+        lse = torch.empty((b,), device = device, dtype = torch.promote_types(logits.dtype, torch.float32))
+
+        for start in range(0, b, block_size):
+            block = upcast(logits[start:(start + block_size)])
+            block_targets = targets[start:(start + block_size), None]
+
+            if decoupled:
+                block = block.scatter(1, block_targets, -float('inf'))
+
+            lse[start:(start + block_size)] = block.logsumexp(dim = -1)
+
+        pos = upcast(logits[torch.arange(b, device = device), targets])
+
+        ctx.save_for_backward(logits, lse)
+        ctx.rank_offset = rank_offset
+        ctx.decoupled = decoupled
+        ctx.block_size = block_size
+
+        return (lse - pos).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        logits, lse = ctx.saved_tensors
+        b, device = logits.shape[0], logits.device
+        block_size = ctx.block_size
+
+        targets = torch.arange(b, device = device) + ctx.rank_offset
+        grad_logits = torch.empty_like(logits)
+        scale = grad_output.to(lse.dtype) / b
+
+        for start in range(0, b, block_size):
+            block_targets = targets[start:(start + block_size), None]
+
+            probs = (upcast(logits[start:(start + block_size)]) - lse[start:(start + block_size), None]).exp()
+
+            if ctx.decoupled:
+                probs.scatter_(1, block_targets, 0.)
+
+            probs.scatter_add_(1, block_targets, -torch.ones_like(block_targets, dtype = probs.dtype))
+            grad_logits[start:(start + block_size)] = probs * scale
+
+        return grad_logits, None, None, None
+
+def fused_contrastive_loss(
+    logits,
+    rank_offset = 0,
+    decoupled = False,
+    block_size = None
+):
+    # logits are (rows x columns), the positive of row i being at column i + rank_offset
+
+    return FusedContrastiveLoss.apply(logits, rank_offset, decoupled, block_size)
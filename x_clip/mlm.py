@@ -7,6 +7,10 @@ import torch.nn.functional as F
 
 # helpers
 
+def upcast(t):
+    # half types are upcast to float32, float32 and float64 are kept as is
+    return t.to(torch.promote_types(t.dtype, torch.float32))
+
 def prob_mask_like(t, prob):
     return torch.zeros_like(t).float().uniform_(0, 1) < prob
 
@@ -65,7 +69,7 @@ class MLM(nn.Module):
         # to text logits
         self.to_logits = nn.Linear(dim, num_tokens)
 
-    def forward(self, input, **kwargs):
+    def get_masked_input_and_labels(self, input):
         # do not mask [pad] tokens, or any other tokens in the tokens designated to be excluded ([cls], [sep])
         # also do not include these special tokens in the tokens chosen at random
         no_mask = mask_with_tokens(input, self.mask_ignore_token_ids)
@@ -94,12 +98,12 @@ class MLM(nn.Module):
         # mask out any tokens to padding tokens that were not originally going to be masked
         labels = input.masked_fill(~mask, self.pad_token_id)
 
-        # get generator output and get mlm loss
-        embedding = self.transformer(masked_input, **kwargs)
+        return masked_input, labels
 
+    def get_loss(self, embedding, labels):
         # project to logits and remove CLS
         logits = self.to_logits(embedding)
-        logits = logits[:, 1:]
+        logits = upcast(logits[:, 1:])
 
         mlm_loss = F.cross_entropy(
             logits.transpose(1, 2),
@@ -108,3 +112,10 @@ class MLM(nn.Module):
         )
 
         return mlm_loss
+
+    def forward(self, input, **kwargs):
+        masked_input, labels = self.get_masked_input_and_labels(input)
+
+        # get generator output and get mlm loss
+        embedding = self.transformer(masked_input, **kwargs)
+        return self.get_loss(embedding, labels)
@@ -0,0 +1,116 @@
+import io
+import copy
+
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, float16_dynamic_qconfig
+import torch.ao.nn.quantized.dynamic as nnqd
+
+from x_clip.x_clip import filip_similarity, filip_text_to_image, masked_mean
+
+# constants
+
+QUANTIZE_DTYPES = dict(
+    int8 = (torch.qint8, default_dynamic_qconfig),          # int8 weights, activations quantized on the fly
+    float16 = (torch.float16, float16_dynamic_qconfig)      # weight only, float16 weights
+)
+
+# only the linears are swapped, embeddings and convolutions stay in float32
+
+QUANTIZE_MAPPING = {nn.Linear: nnqd.Linear}
+
+# helper functions
+
+def exists(val):
+    return val is not None
+
+def get_serialized_size(module):
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.getbuffer().nbytes
+
+def get_tower_names(clip):
+    names = ['text_transformer', 'visual_transformer', 'to_text_latent', 'to_visual_latent']
+
+    if clip.extra_latent_projection:
+        names.extend(['to_text_latent_extra', 'to_visual_latent_extra'])
+
+    return names
+
+# quantizing the text and image towers for cpu inference
+# only the encoders and latent projections are quantized, the training only modules (MLM, visual SSL) are left as is
+
+def quantize_for_inference(
+    clip,
+    dtype = 'int8',
+    inplace = False
+):
+    assert dtype in QUANTIZE_DTYPES, f'dtype must be one of {tuple(QUANTIZE_DTYPES.keys())}'
+    quantized_dtype, qconfig = QUANTIZE_DTYPES[dtype]
+
+    clip = clip if inplace else copy.deepcopy(clip)
+    clip.eval().requires_grad_(False)
+
+    # dynamically quantized linears run in float32, and do not go through autocast
+
+    clip.precision = 'fp32'
+
+    qconfig_spec = {name: qconfig for name in get_tower_names(clip)}
+    return quantize_dynamic(clip, qconfig_spec, dtype = quantized_dtype, mapping = QUANTIZE_MAPPING, inplace = True)
+
+def towers_size(clip):
+    # serialized size in bytes of the text and image towers
+
+    return sum(get_serialized_size(getattr(clip, name)) for name in get_tower_names(clip))
+
+# evaluating the drift of the quantized latents from the float32 ones
+
+def cosine_drift(latents, quantized_latents, mask = None):
+    drift = 1. - (latents * quantized_latents).sum(dim = -1)
+
+    if latents.ndim == 3:
+        drift = masked_mean(drift, mask, dim = -1) if exists(mask) else drift.mean(dim = -1)
+
+    return dict(mean = drift.mean().item(), max = drift.amax().item())
+
+def retrieval_scores(clip, text_latents, image_latents, text_mask = None):
+    if clip.use_all_token_embeds:
+        return filip_similarity(filip_text_to_image, text_latents, image_latents, text_mask = text_mask, chunk_size = clip.filip_chunk_size)
+
+    return text_latents @ image_latents.t()
+
+def recall_at_k(scores, quantized_scores, ks):
+    # fraction of queries whose float32 top 1 is retrieved within the quantized top k
+
+    top1 = scores.argmax(dim = -1, keepdim = True)
+    ranked = quantized_scores.topk(min(max(ks), quantized_scores.shape[-1]), dim = -1).indices
+
+    return {k: (ranked[:, :k] == top1).any(dim = -1).float().mean().item() for k in ks}
+
+@torch.inference_mode()
+def evaluate_quantization(
+    clip,
+    quantized_clip,
+    text,
+    images,
+    text_mask = None,
+    ks = (1, 5, 10),
+    batch_size = 256
+):
+    text_latents = clip.embed_text(text, text_mask, batch_size = batch_size)
+    image_latents = clip.embed_image(images, batch_size = batch_size)
+
+    quantized_text_latents = quantized_clip.embed_text(text, text_mask, batch_size = batch_size)
+    quantized_image_latents = quantized_clip.embed_image(images, batch_size = batch_size)
+
+    scores = retrieval_scores(clip, text_latents, image_latents, text_mask)
+    quantized_scores = retrieval_scores(clip, quantized_text_latents, quantized_image_latents, text_mask)
+
+    return dict(
+        text_cosine_drift = cosine_drift(text_latents, quantized_text_latents, text_mask),
+        image_cosine_drift = cosine_drift(image_latents, quantized_image_latents),
+        text_to_image_recall = recall_at_k(scores, quantized_scores, ks),
+        image_to_text_recall = recall_at_k(scores.t(), quantized_scores.t(), ks),
+        size = towers_size(clip),
+        quantized_size = towers_size(quantized_clip)
+    )
@@ -0,0 +1,56 @@
+import math
+
+import torch
+from torch.utils.data import Sampler
+
+# batch sampler that groups texts of similar token length together
+# indices are shuffled, split into pools of batch_size * bucket_size_multiplier, sorted by length within each pool, then cut into batches whose order is shuffled again
+
+class LengthBucketBatchSampler(Sampler):
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        bucket_size_multiplier = 100,
+        shuffle = True,
+        drop_last = False,
+        seed = 0
+    ):
+        self.lengths = torch.as_tensor(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        num_samples = len(self.lengths)
+
+        if self.drop_last:
+            return num_samples // self.batch_size
+
+        return math.ceil(num_samples / self.batch_size)
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        num_samples = len(self.lengths)
+
+        indices = torch.randperm(num_samples, generator = generator) if self.shuffle else torch.arange(num_samples)
+
+        batches = []
+        for bucket in indices.split(self.bucket_size):
+            bucket = bucket[self.lengths[bucket].argsort(stable = True)]
+            batches.extend(bucket.split(self.batch_size))
+
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator = generator).tolist()]
+
+        for batch in batches:
+            yield batch.tolist()
@@ -2,9 +2,16 @@
 # to give users a quick easy start to training DALL-E without doing BPE
 
 import torch
+import numpy as np
 
+import gc
 import html
+import heapq
+import math
 import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from functools import lru_cache
 from pathlib import Path
 import ftfy
@@ -16,6 +23,10 @@ import regex as re
 def default_bpe():
     return os.path.join(os.path.dirname(os.path.abspath(__file__)), "data/bpe_simple_vocab_16e6.txt")
 
+@lru_cache()
+def default_compiled_bpe():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "data/bpe_simple_vocab_16e6.npy")
+
 @lru_cache()
 def bytes_to_unicode():
     bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
@@ -29,14 +40,6 @@ def bytes_to_unicode():
     cs = [chr(n) for n in cs]
     return dict(zip(bs, cs))
 
-def get_pairs(word):
-    pairs = set()
-    prev_char = word[0]
-    for char in word[1:]:
-        pairs.add((prev_char, char))
-        prev_char = char
-    return pairs
-
 def basic_clean(text):
     text = ftfy.fix_text(text)
     text = html.unescape(html.unescape(text))
@@ -47,70 +50,218 @@ def whitespace_clean(text):
     text = text.strip()
     return text
 
+@contextmanager
+def gc_disabled():
+    # building the vocab allocates enough tuples to trigger a full collection, which is slow with a large heap (torch) already loaded
+
+    enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+# merges
+
+def base_vocab():
+    vocab = list(bytes_to_unicode().values())
+    return vocab + [v + '</w>' for v in vocab]
+
+def read_merges(bpe_path):
+    merges = Path(bpe_path).read_text(encoding='utf8').split('\n')
+    merges = merges[1:49152 - 256 - 2 + 1]
+    return [tuple(merge.split()) for merge in merges]
+
+def compile_merges(bpe_path, compiled_path):
+    # precompiled merges are stored as a (num_merges, 2) uint16 table of the vocab ids of each merged pair
+    # every merge only refers to tokens of the base vocab or earlier merges, so the vocab is rebuilt from the table alone
+
+    merges = read_merges(bpe_path)
+    vocab = base_vocab()
+    encoder = {token: i for i, token in enumerate(vocab)}
+    pair_ids = []
+
+    for first, second in merges:
+        pair_ids.append((encoder[first], encoder[second]))
+        encoder[first + second] = len(vocab)
+        vocab.append(first + second)
+
+    np.save(compiled_path, np.array(pair_ids, dtype = np.uint16))
+
+def load_compiled_merges(compiled_path):
+    vocab = base_vocab()
+    token_by_id = vocab[:]
+    merges = []
+
+    table = np.load(compiled_path)
+
+    for first_id, second_id in zip(table[:, 0].tolist(), table[:, 1].tolist()):
+        first, second = token_by_id[first_id], token_by_id[second_id]
+        merges.append((first, second))
+        token_by_id.append(first + second)
+
+    return merges
+
+# bounded least recently used cache of bpe results, with hit / miss counters
+
+class LRUCache(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key):
+        value = self.data.get(key)
+
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if self.capacity <= 0:
+            return
+
+        self.data[key] = value
+        self.data.move_to_end(key)
+
+        if len(self.data) > self.capacity:
+            self.data.popitem(last = False)
+
+    def clear(self):
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return dict(hits = self.hits, misses = self.misses, size = len(self.data), capacity = self.capacity)
+
+# tokenizer owned by each worker process of the parallel tokenization pool, so the bpe cache persists per worker
+
+worker_tokenizer = None
+
+def init_worker_tokenizer(bpe_path, cache_size):
+    global worker_tokenizer
+    worker_tokenizer = SimpleTokenizer(bpe_path, cache_size = cache_size)
+
+def encode_in_worker(texts):
+    return [worker_tokenizer.encode(text) for text in texts]
+
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path = default_bpe()):
+    def __init__(self, bpe_path = None, cache_size = 2 ** 16):
+        # defaults to the precompiled merges shipped with the package, which load faster than parsing the merges text file
+        # bpe_path can point to either a merges text file or a table precompiled with compile_merges (.npy)
+
+        if bpe_path is None:
+            bpe_path = default_compiled_bpe() if os.path.exists(default_compiled_bpe()) else default_bpe()
+
+        self.bpe_path = bpe_path
+        self.cache_size = cache_size
+        self.pool = None
+        self.pool_num_workers = None
+
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        merges = Path(bpe_path).read_text(encoding='utf8').split('\n')
-        merges = merges[1:49152 - 256 - 2 + 1]
-        merges = [tuple(merge.split()) for merge in merges]
-        vocab = list(bytes_to_unicode().values())
-        vocab = vocab + [v + '</w>' for v in vocab]
-        for merge in merges:
-            vocab.append(''.join(merge))
-        vocab.extend(['<|startoftext|>', '<|endoftext|>'])
 
-        self.vocab_size = 49408
+        with gc_disabled():
+            merges = load_compiled_merges(bpe_path) if str(bpe_path).endswith('.npy') else read_merges(bpe_path)
+            vocab = base_vocab()
+            for merge in merges:
+                vocab.append(''.join(merge))
+            vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+
+            self.encoder = dict(zip(vocab, range(len(vocab))))
+            self.decoder = {v: k for k, v in self.encoder.items()}
+            self.bpe_ranks = dict(zip(merges, range(len(merges))))
 
-        self.encoder = dict(zip(vocab, range(len(vocab))))
-        self.decoder = {v: k for k, v in self.encoder.items()}
-        self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        self.vocab_size = 49408
+        self.bpe_merges = merges
+        self.special_tokens = {'<|startoftext|>', '<|endoftext|>'}
+        self.cache = LRUCache(cache_size)
         self.pat = re.compile(
             r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""",
             re.IGNORECASE)
 
     def bpe(self, token):
-        if token in self.cache:
-            return self.cache[token]
-        word = tuple(token[:-1]) + (token[-1] + '</w>',)
-        pairs = get_pairs(word)
+        if token in self.special_tokens:
+            return token
 
-        if not pairs:
+        # single symbols (digits, one character punctuation) have nothing to merge, and bypass the cache and its counters
+
+        if len(token) == 1:
             return token + '</w>'
 
-        while True:
-            bigram = min(pairs, key=lambda pair: self.bpe_ranks.get(pair, float('inf')))
-            if bigram not in self.bpe_ranks:
-                break
-            first, second = bigram
-            new_word = []
-            i = 0
-            while i < len(word):
-                try:
-                    j = word.index(first, i)
-                    new_word.extend(word[i:j])
-                    i = j
-                except:
-                    new_word.extend(word[i:])
-                    break
-
-                if word[i] == first and i < len(word) - 1 and word[i + 1] == second:
-                    new_word.append(first + second)
-                    i += 2
-                else:
-                    new_word.append(word[i])
-                    i += 1
-            new_word = tuple(new_word)
-            word = new_word
-            if len(word) == 1:
-                break
-            else:
-                pairs = get_pairs(word)
-        word = ' '.join(word)
+        cached = self.cache.get(token)
+        if cached is not None:
+            return cached
+
+        word = list(token[:-1]) + [token[-1] + '</w>']
+
+        # symbols form a linked list, with a heap of (rank, position) of all mergeable adjacent pairs
+        # all occurrences of the lowest ranked pair are merged left to right before moving on to the next rank, same as the reference implementation
+
+        ranks = self.bpe_ranks
+        next_index = [*range(1, len(word)), -1]
+        prev_index = [*range(-1, len(word) - 1)]
+
+        heap = [(ranks[pair], i) for i, pair in enumerate(zip(word, word[1:])) if pair in ranks]
+        heapq.heapify(heap)
+
+        while heap:
+            rank = heap[0][0]
+            first, second = self.bpe_merges[rank]
+
+            positions = []
+            while heap and heap[0][0] == rank:
+                positions.append(heapq.heappop(heap)[1])
+
+            for i in positions:
+                j = next_index[i]
+
+                # skip stale entries, whose symbols have since been merged away or changed
+
+                if word[i] != first or j == -1 or word[j] != second:
+                    continue
+
+                merged = first + second
+                word[i], word[j] = merged, None
+
+                k = next_index[j]
+                next_index[i] = k
+
+                if k != -1:
+                    prev_index[k] = i
+
+                    pair_rank = ranks.get((merged, word[k]))
+                    if pair_rank is not None:
+                        heapq.heappush(heap, (pair_rank, i))
+
+                h = prev_index[i]
+
+                if h != -1:
+                    pair_rank = ranks.get((word[h], merged))
+                    if pair_rank is not None:
+                        heapq.heappush(heap, (pair_rank, h))
+
+        word = ' '.join(symbol for symbol in word if symbol is not None)
         self.cache[token] = word
         return word
 
+    def cache_info(self):
+        return self.cache.info()
+
     def encode(self, text):
         bpe_tokens = []
         text = whitespace_clean(basic_clean(text)).lower()
@@ -129,21 +280,92 @@ class SimpleTokenizer(object):
         text = bytearray([self.byte_decoder[c] for c in text]).decode('utf-8', errors="replace").replace('</w>', ' ')
         return text
 
-    def tokenize(self, texts, context_length = 256, truncate_text = False):
+    def get_pool(self, num_workers):
+        if self.pool_num_workers != num_workers:
+            self.close_pool()
+            self.pool = ProcessPoolExecutor(num_workers, initializer = init_worker_tokenizer, initargs = (self.bpe_path, self.cache_size))
+            self.pool_num_workers = num_workers
+
+        return self.pool
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+        self.pool = None
+        self.pool_num_workers = None
+
+    def encode_batch(self, texts, num_workers = 0, chunk_size = 1024):
+        if num_workers == 0 or len(texts) <= chunk_size:
+            return [self.encode(text) for text in texts]
+
+        pool = self.get_pool(num_workers)
+        chunks = [texts[i:(i + chunk_size)] for i in range(0, len(texts), chunk_size)]
+        return [tokens for chunk_tokens in pool.map(encode_in_worker, chunks) for tokens in chunk_tokens]
+
+    def lengths(self, texts, num_workers = 0, chunk_size = 1024):
+        # number of tokens each text encodes to, for bucketing texts of similar length together
+
+        if isinstance(texts, str):
+            texts = [texts]
+
+        return [len(tokens) for tokens in self.encode_batch(list(texts), num_workers = num_workers, chunk_size = chunk_size)]
+
+    def tokenize(
+        self,
+        texts,
+        context_length = 256,
+        truncate_text = False,
+        num_workers = 0,            # if greater than 0, texts are encoded in chunks of chunk_size over a pool of this many processes
+        chunk_size = 1024,
+        pad_to_longest = False,     # pad only up to the longest text in the batch (at most context_length), rather than always to context_length
+        pad_to_multiple_of = None,  # round the padded length up to a multiple of this, when padding to the longest
+        return_mask = False         # also return the boolean mask of the non-padding tokens, to be passed as the text_mask to CLIP
+    ):
         if isinstance(texts, str):
             texts = [texts]
 
-        all_tokens = [self.encode(text) for text in texts]
-        result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
+        all_tokens = self.encode_batch(list(texts), num_workers = num_workers, chunk_size = chunk_size)
 
         for i, tokens in enumerate(all_tokens):
             if len(tokens) > context_length:
                 if truncate_text:
-                    tokens = tokens[:context_length]
+                    all_tokens[i] = tokens[:context_length]
                 else:
                     raise RuntimeError(f"Input {texts[i]} is too long for context length {context_length}")
-            result[i, :len(tokens)] = torch.tensor(tokens)
 
-        return result
+        lengths = np.array([len(tokens) for tokens in all_tokens], dtype = np.int64)
+
+        seq_len = context_length
+
+        if pad_to_longest:
+            seq_len = int(lengths.max(initial = 1))
+
+            if pad_to_multiple_of is not None:
+                seq_len = math.ceil(seq_len / pad_to_multiple_of) * pad_to_multiple_of
+
+            seq_len = min(seq_len, context_length)
+
+        result = np.zeros((len(all_tokens), seq_len), dtype = np.int64)
+
+        for i, tokens in enumerate(all_tokens):
+            result[i, :len(tokens)] = tokens
+
+        result = torch.from_numpy(result)
+
+        if not return_mask:
+            return result
+
+        mask = torch.arange(seq_len) < torch.from_numpy(lengths)[:, None]
+        return result, mask
+
+# the default tokenizer is only constructed on first access of `tokenizer`, so importing this module stays cheap
+
+@lru_cache()
+def get_tokenizer():
+    return SimpleTokenizer()
 
-tokenizer = SimpleTokenizer()
+def __getattr__(name):
+    if name == 'tokenizer':
+        return get_tokenizer()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
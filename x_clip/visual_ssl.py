@@ -1,13 +1,14 @@
 import copy
+import math
 import random
 from functools import wraps
 
 import torch
-from torch import nn
+from torch import nn, einsum
 import torch.nn.functional as F
 
 from torchvision import transforms as T
-from einops import rearrange
+from einops import rearrange, repeat
 
 # augmentations
 
@@ -35,8 +36,159 @@ def get_default_aug(image_size):
         ),
         T.RandomResizedCrop((image_size, image_size)),
         T.Normalize(
-            mean=torch.tensor([0.485, 0.456, 0.406]),
-            std=torch.tensor([0.229, 0.224, 0.225])),
+            mean=(0.485, 0.456, 0.406),
+            std=(0.229, 0.224, 0.225)),
+    )
+
+# batched augmentations, with random parameters drawn per sample and applied in one vectorized pass
+
+def rand_uniform(shape, low, high, device):
+    return torch.empty(shape, device = device).uniform_(low, high)
+
+def prob_mask(batch, prob, device):
+    return torch.rand(batch, device = device) < prob
+
+def where_sample(mask, augmented, x):
+    return torch.where(rearrange(mask, 'b -> b 1 1 1'), augmented, x)
+
+def rgb_to_grayscale(x):
+    r, g, b = x.unbind(dim = 1)
+    return rearrange(0.299 * r + 0.587 * g + 0.114 * b, 'b h w -> b 1 h w')
+
+class BatchColorJitter(nn.Module):
+    def __init__(self, brightness = 0., contrast = 0., saturation = 0., hue = 0., p = 1.):
+        super().__init__()
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.p = p
+
+    def forward(self, x):
+        b, device = x.shape[0], x.device
+        out = x
+
+        def factor(amount):
+            return rand_uniform((b, 1, 1, 1), max(0., 1 - amount), 1 + amount, device)
+
+        if self.brightness > 0:
+            out = (out * factor(self.brightness)).clamp(0., 1.)
+
+        if self.contrast > 0:
+            mean = rgb_to_grayscale(out).mean(dim = (-1, -2), keepdim = True)
+            out = torch.lerp(mean, out, factor(self.contrast)).clamp(0., 1.)
+
+        if self.saturation > 0:
+            out = torch.lerp(rgb_to_grayscale(out), out, factor(self.saturation)).clamp(0., 1.)
+
+        if self.hue > 0:
+            # hue is shifted by rotating the chroma in YIQ space, a cheap vectorized approximation of the rotation in HSV
+
+            angle = rand_uniform((b,), -self.hue, self.hue, device) * 2 * math.pi
+            cos, sin = angle.cos(), angle.sin()
+
+            rgb_to_yiq = torch.tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]], device = device)
+            yiq_to_rgb = torch.linalg.inv(rgb_to_yiq)
+
+            rotation = torch.zeros((b, 3, 3), device = device)
+            rotation[:, 0, 0] = 1.
+            rotation[:, 1, 1], rotation[:, 1, 2] = cos, -sin
+            rotation[:, 2, 1], rotation[:, 2, 2] = sin, cos
+
+            transform = yiq_to_rgb @ rotation @ rgb_to_yiq
+            out = einsum('b i j, b j h w -> b i h w', transform.to(out.dtype), out).clamp(0., 1.)
+
+        return where_sample(prob_mask(b, self.p, device), out, x)
+
+class BatchRandomGrayscale(nn.Module):
+    def __init__(self, p = 0.1):
+        super().__init__()
+        self.p = p
+
+    def forward(self, x):
+        gray = rgb_to_grayscale(x).expand_as(x)
+        return where_sample(prob_mask(x.shape[0], self.p, x.device), gray, x)
+
+class BatchRandomHorizontalFlip(nn.Module):
+    def __init__(self, p = 0.5):
+        super().__init__()
+        self.p = p
+
+    def forward(self, x):
+        return where_sample(prob_mask(x.shape[0], self.p, x.device), x.flip(-1), x)
+
+class BatchGaussianBlur(nn.Module):
+    def __init__(self, kernel_size = 3, sigma = (0.1, 2.0), p = 1.):
+        super().__init__()
+        assert kernel_size % 2 == 1, 'kernel size must be odd'
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+        self.p = p
+
+    def forward(self, x):
+        b, c, h, w, device = *x.shape, x.device
+        padding = self.kernel_size // 2
+
+        # per sample separable gaussian kernels, applied to every channel of every sample with one grouped convolution each way
+
+        sigma = rand_uniform((b, 1), *self.sigma, device)
+        coords = torch.arange(self.kernel_size, device = device) - padding
+        kernel = (-(coords ** 2) / (2 * sigma ** 2)).exp()
+        kernel = kernel / kernel.sum(dim = -1, keepdim = True)
+        kernel = repeat(kernel, 'b k -> (b c) k', c = c).to(x.dtype)
+
+        out = rearrange(x, 'b c h w -> 1 (b c) h w')
+        out = F.pad(out, (padding, padding, padding, padding), mode = 'reflect')
+        out = F.conv2d(out, rearrange(kernel, 'n k -> n 1 k 1'), groups = b * c)
+        out = F.conv2d(out, rearrange(kernel, 'n k -> n 1 1 k'), groups = b * c)
+        out = rearrange(out, '1 (b c) h w -> b c h w', b = b)
+
+        return where_sample(prob_mask(b, self.p, device), out, x)
+
+class BatchRandomResizedCrop(nn.Module):
+    def __init__(self, size, scale = (0.08, 1.0), ratio = (3. / 4., 4. / 3.)):
+        super().__init__()
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+
+    def forward(self, x):
+        b, c, device = x.shape[0], x.shape[1], x.device
+
+        # crop width and height, as fractions of the image, with a random area and log-uniform aspect ratio per sample
+
+        area = rand_uniform((b,), *self.scale, device)
+        log_ratio = rand_uniform((b,), math.log(self.ratio[0]), math.log(self.ratio[1]), device)
+        ratio = log_ratio.exp()
+
+        crop_w = (area * ratio).sqrt().clamp(max = 1.)
+        crop_h = (area / ratio).sqrt().clamp(max = 1.)
+
+        center_x = (torch.rand(b, device = device) * 2 - 1) * (1 - crop_w)
+        center_y = (torch.rand(b, device = device) * 2 - 1) * (1 - crop_h)
+
+        # crop and resize all samples in one pass, by sampling the affine grids of the crops
+
+        theta = torch.zeros((b, 2, 3), device = device)
+        theta[:, 0, 0], theta[:, 0, 2] = crop_w, center_x
+        theta[:, 1, 1], theta[:, 1, 2] = crop_h, center_y
+
+        size = self.size if isinstance(self.size, tuple) else (self.size, self.size)
+        grid = F.affine_grid(theta.to(x.dtype), (b, c, *size), align_corners = False)
+        return F.grid_sample(x, grid, mode = 'bilinear', padding_mode = 'reflection', align_corners = False)
+
+def get_batch_aug(image_size):
+    # same augmentations as get_default_aug, but with every random choice made per sample rather than per batch
+
+    return torch.nn.Sequential(
+        BatchColorJitter(0.8, 0.8, 0.8, 0.2, p = 0.3),
+        BatchRandomGrayscale(p = 0.2),
+        BatchRandomHorizontalFlip(),
+        BatchGaussianBlur(3, (1.0, 2.0), p = 0.2),
+        BatchRandomResizedCrop((image_size, image_size)),
+        T.Normalize(
+            mean=(0.485, 0.456, 0.406),
+            std=(0.229, 0.224, 0.225)),
     )
 
 # helper functions
@@ -71,6 +223,32 @@ def set_requires_grad(model, val):
 def l2norm(t):
     return F.normalize(t, p = 2, dim = -1)
 
+def upcast(t):
+    # half types are upcast to float32, float32 and float64 are kept as is
+    return t.to(torch.promote_types(t.dtype, torch.float32))
+
+# exponential moving average
+
+class EMA():
+    def __init__(self, beta):
+        super().__init__()
+        self.beta = beta
+
+    @torch.no_grad()
+    def update_(self, ma_tensor, current_tensor):
+        if not ma_tensor.is_floating_point():
+            ma_tensor.copy_(current_tensor)
+            return
+
+        ma_tensor.lerp_(current_tensor, 1 - self.beta)
+
+def update_moving_average(ema_updater, ma_model, current_model):
+    for current_params, ma_params in zip(current_model.parameters(), ma_model.parameters()):
+        ema_updater.update_(ma_params.data, current_params.data)
+
+    for current_buffer, ma_buffer in zip(current_model.buffers(), ma_model.buffers()):
+        ema_updater.update_(ma_buffer, current_buffer)
+
 # simclr loss fn
 
 def contrastive_loss(queries, keys, temperature = 0.1):
@@ -84,7 +262,7 @@ def nt_xent_loss(queries, keys, temperature = 0.1):
     b, device = queries.shape[0], queries.device
 
     n = b * 2
-    projs = torch.cat((queries, keys))
+    projs = upcast(torch.cat((queries, keys)))
     logits = projs @ projs.t()
 
     mask = torch.eye(n, device=device).bool()
@@ -99,8 +277,8 @@ def nt_xent_loss(queries, keys, temperature = 0.1):
 # loss fn
 
 def loss_fn(x, y):
-    x = l2norm(x)
-    y = l2norm(y)
+    x = l2norm(upcast(x))
+    y = l2norm(upcast(y))
     return 2 - 2 * (x * y).sum(dim=-1)
 
 # MLP class for projector and predictor
@@ -108,10 +286,13 @@ def loss_fn(x, y):
 class MLP(nn.Module):
     def __init__(self, dim, projection_size, hidden_size = None):
         super().__init__()
+        assert dim is not None or hidden_size is not None, 'hidden size must be given if the input dimension is to be inferred'
         hidden_size = default(hidden_size, dim)
 
+        # the input dimension is inferred on the first forward if not given
+
         self.net = nn.Sequential(
-            nn.Linear(dim, hidden_size),
+            nn.Linear(dim, hidden_size) if dim is not None else nn.LazyLinear(hidden_size),
             nn.BatchNorm1d(hidden_size),
             nn.ReLU(inplace=True),
             nn.Linear(hidden_size, projection_size)
@@ -120,19 +301,32 @@ class MLP(nn.Module):
     def forward(self, x):
         return self.net(x)
 
+def infer_output_dim(net):
+    # feature dimension of the network output, read off its last registered linear or layernorm, without a forward pass
+
+    for module in reversed([*net.modules()]):
+        if isinstance(module, nn.Linear):
+            return module.out_features
+
+        if isinstance(module, nn.LayerNorm):
+            return module.normalized_shape[-1]
+
+    return None
+
 # a wrapper class for the base neural network
 # will manage the interception of the hidden layer output
 # and pipe it into the projecter and predictor nets
 
 class NetWrapper(nn.Module):
-    def __init__(self, net, projection_size, projection_hidden_size = None, layer = -2):
+    def __init__(self, net, projection_size, projection_hidden_size = None, layer = -2, dim = None):
         super().__init__()
         self.net = net
         self.layer = layer
 
-        self.projector = None
-        self.projection_size = projection_size
-        self.projection_hidden_size = projection_hidden_size
+        # the projector is always built upfront, so optimizers and state dicts see it from construction
+        # if the input dimension is not given, the first linear of the projector infers it lazily
+
+        self.projector = MLP(dim, projection_size, projection_hidden_size)
 
         self.hidden = {}
         self.hook_registered = False
@@ -156,12 +350,6 @@ class NetWrapper(nn.Module):
         handle = layer.register_forward_hook(self._hook)
         self.hook_registered = True
 
-    @singleton('projector')
-    def _get_projector(self, hidden):
-        _, dim = hidden.shape
-        projector = MLP(dim, self.projection_size, self.projection_hidden_size)
-        return projector.to(hidden)
-
     def get_representation(self, x):
         if self.layer == -1:
             return self.net(x)
@@ -184,8 +372,7 @@ class NetWrapper(nn.Module):
             return representation
 
         flattened_representation = rearrange(representation, 'b n d -> (b n) d')
-        projector = self._get_projector(flattened_representation)
-        projection = projector(flattened_representation)
+        projection = self.projector(flattened_representation)
         return projection, representation
 
 # main class
@@ -199,7 +386,10 @@ class SimSiam(nn.Module):
         projection_size = 256,
         projection_hidden_size = 4096,
         augment_fn = None,
-        augment_fn2 = None
+        augment_fn2 = None,
+        dim = None,                     # dimension of the hidden layer output, inferred on first forward if not given
+        use_momentum = False,           # use an exponential moving average of the online encoder as the target encoder, as in BYOL
+        moving_average_decay = 0.99
     ):
         super().__init__()
         self.net = net
@@ -209,15 +399,28 @@ class SimSiam(nn.Module):
         self.augment1 = default(augment_fn, get_default_aug(image_size))
         self.augment2 = default(augment_fn2, self.augment1)
 
-        self.online_encoder = NetWrapper(net, projection_size, projection_hidden_size, layer=hidden_layer)
+        self.online_encoder = NetWrapper(net, projection_size, projection_hidden_size, layer=hidden_layer, dim=dim)
         self.online_predictor = MLP(projection_size, projection_size, projection_hidden_size)
 
+        self.use_momentum = use_momentum
+        self.target_encoder = None
+        self.target_ema_updater = EMA(moving_average_decay)
+
         # get device of network and make wrapper same device
         device = get_module_device(net)
         self.to(device)
 
-        # send a mock image tensor to instantiate singleton parameters
-        self.forward(torch.randn(2, 3, image_size, image_size, device=device))
+    @singleton('target_encoder')
+    def _get_target_encoder(self):
+        target_encoder = copy.deepcopy(self.online_encoder)
+        set_requires_grad(target_encoder, False)
+        return target_encoder
+
+    def update_moving_average(self):
+        # to be called after each optimizer step, when using the momentum target encoder
+        assert self.use_momentum, 'you do not need to update the moving average, since you have turned off momentum for the target encoder'
+        assert self.target_encoder is not None, 'target encoder has not been created yet'
+        update_moving_average(self.target_ema_updater, self.target_encoder, self.online_encoder)
 
     def forward(self, x):
         assert not (self.training and x.shape[0] == 1), 'you must have greater than 1 sample when training, due to the batchnorm in the projection layer'
@@ -230,12 +433,16 @@ class SimSiam(nn.Module):
         online_pred_one = self.online_predictor(online_proj_one)
         online_pred_two = self.online_predictor(online_proj_two)
 
-        with torch.no_grad():
-            target_encoder = self.online_encoder
-            target_proj_one, _ = target_encoder(image_one)
-            target_proj_two, _ = target_encoder(image_two)
-            target_proj_one.detach_()
-            target_proj_two.detach_()
+        # without momentum, the target projections are the online projections with a stop gradient, so no further encoder passes are needed
+
+        if self.use_momentum:
+            with torch.no_grad():
+                target_encoder = self._get_target_encoder()
+                target_proj_one, _ = target_encoder(image_one)
+                target_proj_two, _ = target_encoder(image_two)
+        else:
+            target_proj_one = online_proj_one.detach()
+            target_proj_two = online_proj_two.detach()
 
         loss_one = loss_fn(online_pred_one, target_proj_two)
         loss_two = loss_fn(online_pred_two, target_proj_one)
@@ -256,10 +463,19 @@ class SimCLR(nn.Module):
         augment_both = True,
         use_nt_xent_loss = False,
         augment_fn = None,
-        temperature = 0.1
+        temperature = 0.1,
+        dim = None          # dimension of the hidden layer output, inferred from the network if the output layer is used
     ):
         super().__init__()
-        self.net = NetWrapper(net, project_dim, layer = hidden_layer)
+
+        # the hidden size of the projector is the hidden layer dimension, so it must be known at construction
+
+        if dim is None and hidden_layer == -1:
+            dim = infer_output_dim(net)
+
+        assert dim is not None, 'dim (the dimension of the hidden layer output) must be given'
+
+        self.net = NetWrapper(net, project_dim, layer = hidden_layer, dim = dim)
         self.augment = default(augment_fn, get_default_aug(image_size))
         self.augment_both = augment_both
         self.temperature = temperature
@@ -268,9 +484,6 @@ class SimCLR(nn.Module):
         device = get_module_device(net)
         self.to(device)
 
-        # send a mock image tensor to instantiate parameters
-        self.forward(torch.randn(1, 3, image_size, image_size))
-
     def forward(self, x):
         b, c, h, w, device = *x.shape, x.device
         transform_fn = self.augment if self.augment_both else noop
@@ -1,16 +1,22 @@
 import math
 import copy
+import time
+from collections import namedtuple
 from contextlib import contextmanager
 from functools import partial
 
 import torch
 import torch.nn.functional as F
 from torch import nn, einsum
+from torch.utils.checkpoint import checkpoint, get_device_states, set_device_states
+from torch.profiler import record_function
 from einops import rearrange, repeat, reduce
 from einops.layers.torch import Rearrange
 
 from x_clip.mlm import MLM
-from x_clip.visual_ssl import SimSiam, SimCLR
+from x_clip.visual_ssl import SimSiam, SimCLR, get_batch_aug
+from x_clip.losses import fused_contrastive_loss
+from x_clip.distributed import is_distributed, get_rank, gather_sizes, all_gather_with_grad, all_gather_mask
 
 # helper functions
 
@@ -24,21 +30,99 @@ def default(val, d):
 def null_context():
     yield
 
+def eval_decorator(fn):
+    def inner(model, *args, **kwargs):
+        was_training = model.training
+        model.eval()
+        out = fn(model, *args, **kwargs)
+        model.train(was_training)
+        return out
+    return inner
+
+def get_rng_state(*tensors):
+    return (torch.get_rng_state(), *get_device_states(*tensors))
+
+@contextmanager
+def replay_rng_state(rng_state):
+    cpu_state, devices, device_states = rng_state
+
+    with torch.random.fork_rng(devices = devices):
+        torch.set_rng_state(cpu_state)
+        set_device_states(devices, device_states)
+        yield
+
+PRECISION_DTYPES = dict(
+    fp32 = torch.float32,
+    bf16 = torch.bfloat16,
+    fp16 = torch.float16
+)
+
 def max_neg_value(dtype):
     return -torch.finfo(dtype).max
 
+def accum_dtype(dtype):
+    # half types are accumulated in float32, float32 and float64 in their own precision
+    return torch.promote_types(dtype, torch.float32)
+
+def upcast(t):
+    return t.to(accum_dtype(t.dtype))
+
 def masked_mean(t, mask, dim = 1, eps = 1e-6):
     t = t.masked_fill(~mask, 0.)
     numer = t.sum(dim = dim)
     denom = mask.sum(dim = dim).clamp(min = eps)
     return numer / denom
 
-def log(t, eps = 1e-20):
-    return torch.log(t + eps)
-
 def l2norm(t):
     return F.normalize(t, dim = -1, p = 2)
 
+def detach_if_tensor(t):
+    return t.detach() if torch.is_tensor(t) else t
+
+# instrumentation of the stages of the forward pass
+
+CLIPStats = namedtuple('CLIPStats', ['times', 'peak_memory', 'losses', 'temperature'])
+
+class StageRecorder:
+    # records the wall time, and on cuda the peak allocated memory, of each named stage
+    # stages show up as record_function ranges whenever the torch profiler is running, and cost nothing otherwise
+
+    def __init__(self, device, enabled = False):
+        self.device = device
+        self.enabled = enabled
+        self.times = dict()
+        self.peak_memory = dict()
+
+    def __call__(self, name):
+        if not self.enabled and not torch.autograd._profiler_enabled():
+            return null_context()
+
+        return self.record(name)
+
+    @contextmanager
+    def record(self, name):
+        with record_function(f'x_clip.{name}'):
+            if not self.enabled:
+                yield
+                return
+
+            # the cuda peak memory statistics are reset at the start of every stage
+
+            is_cuda = self.device.type == 'cuda'
+
+            if is_cuda:
+                torch.cuda.synchronize(self.device)
+                torch.cuda.reset_peak_memory_stats(self.device)
+
+            start = time.perf_counter()
+            yield
+
+            if is_cuda:
+                torch.cuda.synchronize(self.device)
+                self.peak_memory[name] = max(self.peak_memory.get(name, 0), torch.cuda.max_memory_allocated(self.device))
+
+            self.times[name] = self.times.get(name, 0.) + time.perf_counter() - start
+
 # helper classes
 
 class RearrangeImage(nn.Module):
@@ -71,36 +155,160 @@ class FeedForward(nn.Module):
     def forward(self, x):
         return self.net(x)
 
+# attention backends
+
+ATTN_BACKENDS = ('einsum', 'sdpa', 'chunked')
+
+def einsum_attention(q, k, v, mask = None, dropout = None):
+    scale = q.shape[-1] ** -0.5
+    sim = einsum('b h i d, b h j d -> b h i j', q, k) * scale
+
+    if exists(mask):
+        mask = rearrange(mask, 'b j -> b 1 1 j')
+        sim = sim.masked_fill(~mask, max_neg_value(sim.dtype))
+
+    # softmax is accumulated in at least float32, for stability under half precision
+
+    attn = sim.softmax(dim = -1, dtype = accum_dtype(sim.dtype)).to(v.dtype)
+
+    if exists(dropout):
+        attn = dropout(attn)
+
+    return einsum('b h i j, b h j d -> b h i d', attn, v)
+
+def sdpa_attention(q, k, v, mask = None, dropout = None):
+    assert hasattr(F, 'scaled_dot_product_attention'), 'the sdpa attention backend requires pytorch 2.0 or above'
+
+    if exists(mask):
+        mask = rearrange(mask, 'b j -> b 1 1 j')
+
+    dropout_p = dropout.p if exists(dropout) and dropout.training else 0.
+    return F.scaled_dot_product_attention(q, k, v, attn_mask = mask, dropout_p = dropout_p)
+
+def online_softmax_step(q, k, v, mask, row_max, row_sum, acc, dropout = None):
+    # fold one chunk of keys / values into the running (max, sum, output) statistics, which are kept in at least float32
+
+    sim = einsum('b h i d, b h j d -> b h i j', q, k).to(row_max.dtype)
+
+    if exists(mask):
+        sim = sim.masked_fill(~rearrange(mask, 'b j -> b 1 1 j'), max_neg_value(sim.dtype))
+
+    new_row_max = torch.maximum(row_max, sim.amax(dim = -1, keepdim = True))
+    correction = (row_max - new_row_max).exp()
+
+    exp_sim = (sim - new_row_max).exp()
+    row_sum = row_sum * correction + exp_sim.sum(dim = -1, keepdim = True)
+
+    if exists(dropout):
+        exp_sim = dropout(exp_sim)
+
+    acc = acc * correction + einsum('b h i j, b h j d -> b h i d', exp_sim.to(v.dtype), v).to(acc.dtype)
+    return new_row_max, row_sum, acc
+
+def chunked_attention(q, k, v, mask = None, dropout = None, chunk_size = 1024):
+    # memory efficient attention (https://arxiv.org/abs/2112.05682) - keys are processed in chunks with an online softmax
+    # so the full i x j similarity matrix is never held in memory, and each chunk is recomputed on backward
+
+    q = q * (q.shape[-1] ** -0.5)
+
+    stats_dtype = accum_dtype(q.dtype)
+
+    row_max = torch.full((*q.shape[:-1], 1), max_neg_value(stats_dtype), device = q.device, dtype = stats_dtype)
+    row_sum = torch.zeros_like(row_max)
+    acc = torch.zeros_like(q, dtype = stats_dtype)
+
+    should_checkpoint = torch.is_grad_enabled() and any(t.requires_grad for t in (q, k, v))
+    step_fn = partial(online_softmax_step, dropout = dropout)
+
+    for start in range(0, k.shape[-2], chunk_size):
+        k_chunk, v_chunk = k[..., start:(start + chunk_size), :], v[..., start:(start + chunk_size), :]
+        mask_chunk = mask[..., start:(start + chunk_size)] if exists(mask) else None
+
+        args = (q, k_chunk, v_chunk, mask_chunk, row_max, row_sum, acc)
+
+        if should_checkpoint:
+            row_max, row_sum, acc = checkpoint(step_fn, *args, use_reentrant = False)
+        else:
+            row_max, row_sum, acc = step_fn(*args)
+
+    return (acc / row_sum).to(q.dtype)
+
+ATTN_FNS = dict(
+    einsum = einsum_attention,
+    sdpa = sdpa_attention,
+    chunked = chunked_attention
+)
+
+# packing of variable length sequences, for running the transformer without padding
+
+PackedLayout = namedtuple('PackedLayout', ['batch_indices', 'seq_indices', 'mask'])
+
+def get_packed_layout(mask):
+    # positions of the real tokens, compacted to the front of each sequence, along with the mask of the compacted block
+
+    batch_indices, token_indices = mask.nonzero(as_tuple = True)
+    seq_indices = (mask.cumsum(dim = -1) - 1)[batch_indices, token_indices]
+
+    seq_lens = mask.sum(dim = -1)
+    packed_mask = torch.arange(int(seq_lens.amax()), device = mask.device) < rearrange(seq_lens, 'b -> b 1')
+    return PackedLayout(batch_indices, seq_indices, packed_mask)
+
+def pack_tokens(t, layout):
+    return t[layout.batch_indices, layout.seq_indices]
+
+def unpack_tokens(t, layout):
+    b, n = layout.mask.shape
+    out = t.new_zeros((b, n, t.shape[-1]))
+    return out.index_put((layout.batch_indices, layout.seq_indices), t)
+
 class Attention(nn.Module):
-    def __init__(self, dim, dim_head = 64, heads = 8, dropout = 0.):
+    def __init__(
+        self,
+        dim,
+        dim_head = 64,
+        heads = 8,
+        dropout = 0.,
+        attn_backend = 'einsum',
+        attn_chunk_size = 1024
+    ):
         super().__init__()
+        assert attn_backend in ATTN_BACKENDS, f'attn_backend must be one of {ATTN_BACKENDS}'
         self.heads = heads
-        self.scale = dim_head ** -0.5
         inner_dim = dim_head * heads
 
         self.to_qkv = nn.Linear(dim, inner_dim * 3, bias = False)
         self.to_out = nn.Linear(inner_dim, dim)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, mask = None):
+        self.attn_backend = attn_backend
+        self.attn_fn = ATTN_FNS[attn_backend]
+
+        if attn_backend == 'chunked':
+            self.attn_fn = partial(self.attn_fn, chunk_size = attn_chunk_size)
+
+    def forward(self, x, mask = None, packed_layout = None):
         h = self.heads
         q, k, v = self.to_qkv(x).chunk(3, dim = -1)
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = h), (q, k, v))
 
-        sim = einsum('b h i d, b h j d -> b h i j', q, k) * self.scale
+        # if the tokens are packed (total tokens x dim), scatter them to per-sequence blocks only for the attention itself
 
-        if exists(mask):
-            mask = rearrange(mask, 'b j -> b 1 1 j')
-            mask_value = -torch.finfo(sim.dtype).max
-            sim = sim.masked_fill(~mask, mask_value)
+        if exists(packed_layout):
+            q, k, v = map(lambda t: unpack_tokens(t, packed_layout), (q, k, v))
+            mask = packed_layout.mask
 
-        attn = sim.softmax(dim = -1)
-        attn = self.dropout(attn)
+        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = h), (q, k, v))
+
+        out = self.attn_fn(q, k, v, mask = mask, dropout = self.dropout)
 
-        out = einsum('b h i j, b h j d -> b h i d', attn, v)
         out = rearrange(out, 'b h n d -> b n (h d)')
+
+        if exists(packed_layout):
+            out = pack_tokens(out, packed_layout)
+
         return self.to_out(out)
 
+CHECKPOINT_POLICIES = ('layer', 'attn', 'ff')
+
 class Transformer(nn.Module):
     def __init__(
         self,
@@ -111,25 +319,68 @@ class Transformer(nn.Module):
         heads = 8,
         attn_dropout = 0.,
         ff_dropout = 0.,
-        ff_mult = 4
+        ff_mult = 4,
+        attn_backend = 'einsum',
+        attn_chunk_size = 1024,
+        checkpoint_every = None,        # recompute the activations of every nth layer on backward, None to turn off
+        checkpoint_policy = 'layer'     # what to recompute in the checkpointed layers - 'layer' (attention and feedforward), 'attn' or 'ff'
     ):
         super().__init__()
+        assert checkpoint_policy in CHECKPOINT_POLICIES, f'checkpoint_policy must be one of {CHECKPOINT_POLICIES}'
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_policy = checkpoint_policy
+
         self.layers = nn.ModuleList([])
         for _ in range(depth):
             self.layers.append(nn.ModuleList([
-                PreNorm(dim, Attention(dim = dim, dim_head = dim_head, heads = heads, dropout = attn_dropout)),
+                PreNorm(dim, Attention(dim = dim, dim_head = dim_head, heads = heads, dropout = attn_dropout, attn_backend = attn_backend, attn_chunk_size = attn_chunk_size)),
                 PreNorm(dim, FeedForward(dim = dim, mult = ff_mult)),
             ]))
 
         self.norm_out = nn.LayerNorm(dim)
 
-    def forward(self, x, mask = None):
-        for attn, ff in self.layers:
-            x = attn(x, mask = mask) + x
-            x = ff(x) + x
+    def forward(self, x, mask = None, unpad = False):
+        if unpad and exists(mask):
+            return self.forward_unpadded(x, mask)
+
+        for ind, (attn, ff) in enumerate(self.layers):
+            x = self.layer_forward(ind, attn, ff, x, mask = mask)
 
         return self.norm_out(x)
 
+    def should_checkpoint(self, layer_index, block):
+        if not exists(self.checkpoint_every) or self.checkpoint_every <= 0 or not torch.is_grad_enabled():
+            return False
+
+        return (layer_index % self.checkpoint_every) == 0 and self.checkpoint_policy == block
+
+    def layer_forward(self, layer_index, attn, ff, x, **attn_kwargs):
+        attn_block = lambda t: attn(t, **attn_kwargs) + t
+        ff_block = lambda t: ff(t) + t
+
+        if self.should_checkpoint(layer_index, 'layer'):
+            return checkpoint(lambda t: ff_block(attn_block(t)), x, use_reentrant = False)
+
+        x = checkpoint(attn_block, x, use_reentrant = False) if self.should_checkpoint(layer_index, 'attn') else attn_block(x)
+        x = checkpoint(ff_block, x, use_reentrant = False) if self.should_checkpoint(layer_index, 'ff') else ff_block(x)
+        return x
+
+    def forward_unpadded(self, x, mask):
+        # only the real tokens are packed into a single (total tokens x dim) buffer, so the norms, projections and feedforwards never see padding
+        # attention is block diagonal, each sequence only attending to itself
+
+        layout = get_packed_layout(mask)
+        packed = x[mask]
+
+        for ind, (attn, ff) in enumerate(self.layers):
+            packed = self.layer_forward(ind, attn, ff, packed, packed_layout = layout)
+
+        packed = self.norm_out(packed)
+
+        out = packed.new_zeros(x.shape)
+        out[mask] = packed
+        return out
+
 # text and vision transformers
 
 class TextTransformer(nn.Module):
@@ -139,9 +390,11 @@ class TextTransformer(nn.Module):
         *,
         num_tokens,
         max_seq_len,
+        unpad = False,      # run the transformer only over the real (unmasked) tokens, packed together without padding
         **kwargs
     ):
         super().__init__()
+        self.unpad = unpad
         self.token_emb = nn.Embedding(num_tokens, dim)
         self.pos_emb = nn.Embedding(max_seq_len, dim)
         self.cls_token = nn.Parameter(torch.randn(dim))
@@ -162,7 +415,7 @@ class TextTransformer(nn.Module):
         if exists(mask):
             mask = F.pad(mask, (1, 0), value = True)
 
-        out = self.transformer(x, mask = mask)
+        out = self.transformer(x, mask = mask, unpad = self.unpad)
         return out
 
 class VisionTransformer(nn.Module):
@@ -205,6 +458,56 @@ class VisionTransformer(nn.Module):
         out = self.transformer(x)
         return out
 
+# fine-grained (FILIP) similarity
+
+def filip_text_to_image(text_latents, image_latents, text_mask = None):
+    sim = einsum('x t d, y i d -> x y t i', text_latents, image_latents)
+    text_to_image = reduce(sim, 'bt bi t i -> bt bi t', 'max')
+
+    if not exists(text_mask):
+        return reduce(text_to_image, 'bt bi t -> bt bi', 'mean')
+
+    text_to_image_mask = rearrange(text_mask, 'bt t -> bt 1 t')
+    return masked_mean(text_to_image, text_to_image_mask, dim = -1)
+
+def filip_image_to_text(text_latents, image_latents, text_mask = None):
+    sim = einsum('x t d, y i d -> x y t i', text_latents, image_latents)
+
+    if exists(text_mask):
+        image_to_text_mask = rearrange(text_mask, 'bt t -> bt 1 t 1')
+        sim = sim.masked_fill(~image_to_text_mask, max_neg_value(sim.dtype))
+
+    return reduce(reduce(sim, 'bt bi t i -> bt bi i', 'max'), 'bt bi i -> bt bi', 'mean')
+
+def filip_similarity(fn, text_latents, image_latents, text_mask = None, chunk_size = None):
+    # returns the (text batch x image batch) FILIP logits
+    # if chunk_size is given, walks over tiles of text and image batch, only ever holding a (chunk x chunk x t x i) similarity tensor
+    # each tile is recomputed on backward, so the memory of the fine-grained loss scales with the logits rather than with batch squared x tokens squared
+
+    if not exists(chunk_size):
+        return fn(text_latents, image_latents, text_mask)
+
+    should_checkpoint = torch.is_grad_enabled() and (text_latents.requires_grad or image_latents.requires_grad)
+
+    rows = []
+    for text_start in range(0, text_latents.shape[0], chunk_size):
+        text_chunk = text_latents[text_start:(text_start + chunk_size)]
+        mask_chunk = text_mask[text_start:(text_start + chunk_size)] if exists(text_mask) else None
+
+        cols = []
+        for image_start in range(0, image_latents.shape[0], chunk_size):
+            image_chunk = image_latents[image_start:(image_start + chunk_size)]
+            args = (text_chunk, image_chunk, mask_chunk)
+
+            if should_checkpoint:
+                cols.append(checkpoint(fn, *args, use_reentrant = False))
+            else:
+                cols.append(fn(*args))
+
+        rows.append(torch.cat(cols, dim = 1))
+
+    return torch.cat(rows, dim = 0)
+
 # main clip class
 
 class CLIP(nn.Module):
@@ -227,17 +530,28 @@ class CLIP(nn.Module):
         visual_patch_size = 32,
         visual_has_cls_token = True,
         channels = 3,
+        attn_backend = 'einsum',        # one of 'einsum' (reference), 'sdpa' (pytorch scaled_dot_product_attention) or 'chunked' (key-chunked online softmax)
+        attn_chunk_size = 1024,         # number of keys processed at a time when using the 'chunked' attention backend
+        checkpoint_every = None,        # activation checkpointing of every nth layer of the text and vision transformers, trading compute for memory
+        checkpoint_policy = 'layer',    # recompute whole layers ('layer'), or only the attention ('attn') or feedforward ('ff') blocks
+        unpad_text = False,             # run the text transformer only over the real tokens given by the text mask, packed without padding
+        filip_chunk_size = None,        # if set, the fine-grained (FILIP) loss is computed over tiles of this many text and image samples, never materializing the full (batch x batch x tokens x tokens) similarity
         use_all_token_embeds = False,
         downsample_image_embeds = False,
         decoupled_contrastive_learning = False,
         extra_latent_projection = False,
         use_mlm = False,
+        mlm_single_text_pass = False,   # encode the clean and the masked text in one batched pass of the text transformer
         text_ssl_loss_weight = 0.05,
         use_visual_ssl = False,
         visual_ssl_type = 'simsiam',
         visual_ssl_hidden_layer = -1,
+        visual_ssl_per_sample_aug = False, # draw the visual ssl augmentations per sample with the batched augmentations, instead of once per batch
         simclr_temperature = 0.1,
-        image_ssl_loss_weight = 0.05
+        image_ssl_loss_weight = 0.05,
+        contrastive_loss_block_size = None,
+        precision = 'fp32',             # compute precision of the encoders - one of 'fp32', 'bf16' or 'fp16' (autocast), latent projections and losses are always computed in (at least) float32
+        distributed_contrastive = False # gather latents across all processes, so that every sample in the global batch serves as a negative
     ):
         super().__init__()
         assert use_all_token_embeds or (visual_has_cls_token or text_has_cls_token), 'CLS token must be included on both vision and text transformers if you are not using fine-grained contrastive learning loss'
@@ -253,8 +567,13 @@ class CLIP(nn.Module):
                 dim = dim_text,
                 num_tokens = num_text_tokens + (1 if use_mlm else 0),
                 max_seq_len = text_seq_len,
+                unpad = unpad_text,
                 depth = text_enc_depth,
-                heads = text_heads
+                heads = text_heads,
+                attn_backend = attn_backend,
+                attn_chunk_size = attn_chunk_size,
+                checkpoint_every = checkpoint_every,
+                checkpoint_policy = checkpoint_policy
             )
 
         # instantiate image transformer
@@ -270,12 +589,17 @@ class CLIP(nn.Module):
                 patch_size = visual_patch_size,
                 channels = channels,
                 depth = visual_enc_depth,
-                heads = visual_heads
+                heads = visual_heads,
+                attn_backend = attn_backend,
+                attn_chunk_size = attn_chunk_size,
+                checkpoint_every = checkpoint_every,
+                checkpoint_policy = checkpoint_policy
             )
 
         # text ssl
 
         self.use_mlm = use_mlm
+        self.mlm_single_text_pass = mlm_single_text_pass
         self.text_ssl_loss_weight = text_ssl_loss_weight
 
         if use_mlm:
@@ -301,7 +625,9 @@ class CLIP(nn.Module):
             self.visual_ssl = ssl_type(
                 self.visual_transformer,
                 image_size = visual_image_size,
-                hidden_layer = visual_ssl_hidden_layer
+                hidden_layer = visual_ssl_hidden_layer,
+                dim = dim_image if visual_ssl_hidden_layer == -1 else None,
+                augment_fn = get_batch_aug(visual_image_size) if visual_ssl_per_sample_aug else None
             )
 
         # text latent projection
@@ -328,6 +654,7 @@ class CLIP(nn.Module):
 
         # from https://arxiv.org/abs/2111.07783 (FILIP paper)
         self.use_all_token_embeds = use_all_token_embeds
+        self.filip_chunk_size = filip_chunk_size
 
         # proposed in https://arxiv.org/abs/2110.06848 (DCL) and https://arxiv.org/abs/2110.11316 (CLOOB)
         self.decoupled_contrastive_learning = decoupled_contrastive_learning
@@ -335,140 +662,305 @@ class CLIP(nn.Module):
         # proposed in https://arxiv.org/abs/2110.11316 (CLOOB)
         self.extra_latent_projection = extra_latent_projection
 
-        self.to_text_latent_extra = copy.deepcopy(self.to_text_latent)
-        self.to_visual_latent_extra = copy.deepcopy(self.to_visual_latent)
+        # rows of the logits processed at a time by the contrastive loss, defaults to all at once
+        self.contrastive_loss_block_size = contrastive_loss_block_size
 
-    def forward(
-        self,
-        text,
-        image,
-        text_mask = None,
-        return_loss = False,
-        freeze_image_encoder = False,   # image encoder is not trained if this is set to True, proposed by LiT paper
-        freeze_text_encoder = False,    # text encoder is not trained if this is set to True
-        text_to_image = True            # in the case the extra projection is turned on, would return different similarity values depending on modality directionality
-    ):
-        b, device = text.shape[0], text.device
+        # mixed precision policy
 
-        # ssl
+        assert precision in PRECISION_DTYPES, f'precision must be one of {tuple(PRECISION_DTYPES.keys())}'
+        self.precision = precision
 
-        text_ssl_loss = 0
-        image_ssl_loss = 0
+        # gather negatives across processes when training data parallel
+        self.distributed_contrastive = distributed_contrastive
 
-        if return_loss:
-            text_ssl_loss = self.mlm(text, mask = text_mask) if self.use_mlm else 0
-            image_ssl_loss = self.visual_ssl(image) if self.use_visual_ssl else 0
+        if extra_latent_projection:
+            self.to_text_latent_extra = copy.deepcopy(self.to_text_latent)
+            self.to_visual_latent_extra = copy.deepcopy(self.to_visual_latent)
+
+        # checkpoints saved before the extra projections became optional always carry them
+
+        self._register_load_state_dict_pre_hook(self.drop_unused_extra_latents)
+
+    def drop_unused_extra_latents(self, state_dict, prefix, *args):
+        if self.extra_latent_projection:
+            return
+
+        extra_prefixes = tuple(f'{prefix}{name}.' for name in ('to_text_latent_extra', 'to_visual_latent_extra'))
 
-        # get encoded text
+        for key in [key for key in state_dict.keys() if key.startswith(extra_prefixes)]:
+            del state_dict[key]
 
+    def autocast(self, device):
+        # encoders run under autocast in the compute dtype of the precision policy
+
+        if self.precision == 'fp32':
+            return null_context()
+
+        return torch.autocast(device_type = device.type, dtype = PRECISION_DTYPES[self.precision])
+
+    @contextmanager
+    def float32_context(self, device):
+        # latent projections and losses are computed in float32, even when called under an outer autocast
+
+        with torch.autocast(device_type = device.type, enabled = False):
+            yield
+
+    def encode_text(
+        self,
+        text,
+        text_mask = None,
+        freeze_text_encoder = False
+    ):
         text_encoding_context = null_context if not freeze_text_encoder else torch.no_grad
 
-        with text_encoding_context():
+        with text_encoding_context(), self.autocast(text.device):
             enc_text = self.text_transformer(text, mask = text_mask)
 
             if freeze_text_encoder:
                 enc_text.detach_()
 
-        # whether to train image encoder, in the case that the image net was pretrained as recommended in LiT
+        return enc_text
 
+    def get_text_latents(
+        self,
+        text,
+        text_mask = None,
+        freeze_text_encoder = False
+    ):
+        enc_text = self.encode_text(text, text_mask, freeze_text_encoder = freeze_text_encoder)
+        return self.get_text_latents_from_encoding(enc_text)
+
+    def get_text_latents_from_encoding(self, enc_text):
+        # depending on whether to do fine-grained CLIP or not, select either all tokens, or CLS tokens only
+
+        if self.use_all_token_embeds:
+            text_embeds = enc_text[:, 1:] if self.text_has_cls_token else enc_text
+        else:
+            text_embeds = enc_text[:, 0]
+
+        # project to latents, with another set of latents for text to image (vs image to text), proposed by CLOOB
+
+        with self.float32_context(text_embeds.device):
+            text_embeds = upcast(text_embeds)
+            text_latents = l2norm(self.to_text_latent(text_embeds))
+            text_latents_extra = l2norm(self.to_text_latent_extra(text_embeds)) if self.extra_latent_projection else text_latents
+
+        return text_latents, text_latents_extra
+
+    def encode_image(
+        self,
+        image,
+        freeze_image_encoder = False
+    ):
         image_encoding_context = null_context if not freeze_image_encoder else torch.no_grad
 
-        with image_encoding_context():
+        with image_encoding_context(), self.autocast(image.device):
             enc_image = self.visual_transformer(image)
 
             if freeze_image_encoder:
                 enc_image.detach_()
 
-        # depending on whether to do fine-grained CLIP or not, select either all tokens, or CLS tokens only
+        return enc_image
+
+    def get_image_latents(
+        self,
+        image,
+        freeze_image_encoder = False
+    ):
+        enc_image = self.encode_image(image, freeze_image_encoder = freeze_image_encoder)
+        return self.get_image_latents_from_encoding(enc_image)
 
+    def get_image_latents_from_encoding(self, enc_image):
         if self.use_all_token_embeds:
-            text_embeds = enc_text[:, 1:] if self.text_has_cls_token else enc_text
             image_embeds = enc_image[:, 1:] if self.visual_has_cls_token else enc_image
         else:
-            text_embeds = enc_text[:, 0]
             image_embeds = enc_image[:, 0]
 
-        # project to latents
+        with self.float32_context(image_embeds.device):
+            image_embeds = upcast(image_embeds)
+            image_latents = l2norm(self.to_visual_latent(image_embeds))
+            image_latents_extra = l2norm(self.to_visual_latent_extra(image_embeds)) if self.extra_latent_projection else image_latents
 
-        text_latents = self.to_text_latent(text_embeds)
-        image_latents = self.to_visual_latent(image_embeds)
-        text_latents, image_latents = map(l2norm, (text_latents, image_latents))
+        return image_latents, image_latents_extra
 
-        # calculate another set of latents for image to text (vs text to image)
-        # proposed by CLOOB
+    @torch.inference_mode()
+    @eval_decorator
+    def embed_text(
+        self,
+        text,
+        text_mask = None,
+        batch_size = 256,
+        return_extra = False    # whether to return the latents from the extra (CLOOB) projection, used for text to image comparisons
+    ):
+        # normalized text latents, encoded batch_size at a time so arbitrarily many texts can be embedded
+        # latents are of shape (batch, dim_latent), or (batch, seq, dim_latent) if using all token embeddings (FILIP)
 
-        text_latents_extra, image_latents_extra = text_latents, image_latents
-        if self.extra_latent_projection:
-            text_latents_extra = self.to_text_latent_extra(text_embeds)
-            image_latents_extra = self.to_visual_latent_extra(image_embeds)
-            text_latents_extra, image_latents_extra = map(l2norm, (text_latents_extra, image_latents_extra))
+        latents = []
 
-        # get temperature
+        for start in range(0, text.shape[0], batch_size):
+            text_chunk = text[start:(start + batch_size)]
+            mask_chunk = text_mask[start:(start + batch_size)] if exists(text_mask) else None
 
-        temp = self.temperature.exp()
+            text_latents, text_latents_extra = self.get_text_latents(text_chunk, mask_chunk)
+            latents.append(text_latents_extra if return_extra else text_latents)
 
-        # early return, if needed
+        return torch.cat(latents, dim = 0)
 
-        if not return_loss and self.use_all_token_embeds:
-            einsum_args = (text_latents_extra, image_latents_extra) if self.extra_latent_projection and not text_to_image else (text_latents, image_latents)
-            return einsum('b t d, b i d -> b t i', *einsum_args) * temp
+    @torch.inference_mode()
+    @eval_decorator
+    def embed_image(
+        self,
+        image,
+        batch_size = 256,
+        return_extra = False    # whether to return the latents from the extra (CLOOB) projection, used for image to text comparisons
+    ):
+        latents = []
 
-        if not return_loss and not self.use_all_token_embeds:
-            einsum_args = (text_latents_extra, image_latents_extra) if self.extra_latent_projection and not text_to_image else (text_latents, image_latents)
-            return einsum('b d, b d -> b', *einsum_args) * temp
+        for start in range(0, image.shape[0], batch_size):
+            image_latents, image_latents_extra = self.get_image_latents(image[start:(start + batch_size)])
+            latents.append(image_latents_extra if return_extra else image_latents)
 
-        # contrastive loss
+        return torch.cat(latents, dim = 0)
 
-        if self.use_all_token_embeds:
-            # fine-grained CLIP logic
-            sim_text_to_image = einsum('x t d, y i d -> x y t i', text_latents, image_latents) * temp
+    def get_contrastive_loss(
+        self,
+        text_latents,
+        image_latents,
+        text_latents_extra,
+        image_latents_extra,
+        text_mask = None
+    ):
+        b, device = text_latents.shape[0], text_latents.device
 
-            sim_image_to_text = sim_text_to_image
-            if self.extra_latent_projection:
-                sim_image_to_text = einsum('x t d, y i d -> x y t i', text_latents_extra, image_latents_extra) * temp
+        with self.float32_context(device):
+            text_latents, image_latents, text_latents_extra, image_latents_extra = map(upcast, (text_latents, image_latents, text_latents_extra, image_latents_extra))
+
+            # get temperature
+
+            temp = self.temperature.exp()
+
+            # gather latents from all processes, if distributed contrastive learning is turned on
+            # each process then computes only its own rows of the global logits, with positives offset by the position of its batch
+
+            rank_offset = 0
+            all_text_latents, all_image_latents = text_latents, image_latents
+            all_text_latents_extra, all_text_mask = text_latents_extra, text_mask
+
+            is_gathered = self.distributed_contrastive and is_distributed()
+
+            if is_gathered:
+                sizes = gather_sizes(text_latents)
+                rank_offset = sum(sizes[:get_rank()])
+
+                all_text_latents, all_image_latents = map(lambda t: all_gather_with_grad(t, sizes), (text_latents, image_latents))
+                all_text_latents_extra = all_gather_with_grad(text_latents_extra, sizes) if self.extra_latent_projection else all_text_latents
 
-            if exists(text_mask):
-                text_to_image = reduce(sim_text_to_image, 'bt bi t i -> bt bi t', 'max')
-                text_to_image_mask = rearrange(text_mask, 'bt t -> bt 1 t')
-                text_to_image = masked_mean(text_to_image, text_to_image_mask, dim = -1)
+                if exists(text_mask):
+                    all_text_mask = all_gather_mask(text_mask, sizes)
 
-                image_to_text_mask = rearrange(text_mask, 'bt t -> bt 1 t 1')
-                masked_sim = sim_image_to_text.masked_fill(~image_to_text_mask, max_neg_value(sim_image_to_text.dtype))
-                image_to_text = reduce(reduce(masked_sim, 'bt bi t i -> bt bi i', 'max'), 'bt bi i -> bi bt', 'mean')
+            # contrastive loss
+
+            if self.use_all_token_embeds:
+                # fine-grained CLIP logic
+                text_to_image = filip_similarity(filip_text_to_image, text_latents * temp, all_image_latents, text_mask = text_mask, chunk_size = self.filip_chunk_size)
+                image_to_text = filip_similarity(filip_image_to_text, all_text_latents_extra * temp, image_latents_extra, text_mask = all_text_mask, chunk_size = self.filip_chunk_size).t()
             else:
-                text_to_image = reduce(reduce(sim_text_to_image, 'bt bi t i -> bt bi t', 'max'), 'bt bi t -> bt bi', 'mean')
-                image_to_text = reduce(reduce(sim_image_to_text, 'bt bi t i -> bt bi i', 'max'), 'bt bi i -> bi bt', 'mean')
-        else:
-            text_to_image = einsum('t d, i d -> t i', text_latents, image_latents) * temp
-            image_to_text = text_to_image.t()
+                text_to_image = einsum('t d, i d -> t i', text_latents, all_image_latents) * temp
+                image_to_text = text_to_image.t()
 
-            if self.extra_latent_projection:
-                image_to_text = einsum('t d, i d -> i t', text_latents_extra, image_latents_extra) * temp
+                if self.extra_latent_projection or is_gathered:
+                    image_to_text = einsum('t d, i d -> i t', all_text_latents_extra, image_latents_extra) * temp
 
-        # calculate loss
+            # calculate loss, with logsumexp, and positives removed from the denominator if using DCL
 
-        # exponentiate
+            loss_kwargs = dict(rank_offset = rank_offset, decoupled = self.decoupled_contrastive_learning, block_size = self.contrastive_loss_block_size)
 
-        text_to_image_exp, image_to_text_exp = map(torch.exp, (text_to_image, image_to_text))
+            text_to_image_loss = fused_contrastive_loss(text_to_image, **loss_kwargs)
+            image_to_text_loss = fused_contrastive_loss(image_to_text, **loss_kwargs)
 
-        # numerators
+            cl_loss = (text_to_image_loss + image_to_text_loss) / 2
 
-        text_to_image_pos, image_to_text_pos = map(torch.diag, (text_to_image_exp, image_to_text_exp))
+        return cl_loss
 
-        # denominator
+    def forward(
+        self,
+        text,
+        image,
+        text_mask = None,
+        return_loss = False,
+        freeze_image_encoder = False,   # image encoder is not trained if this is set to True, proposed by LiT paper
+        freeze_text_encoder = False,    # text encoder is not trained if this is set to True
+        text_to_image = True,           # in the case the extra projection is turned on, would return different similarity values depending on modality directionality
+        return_stats = False            # also return the time (and peak memory on cuda) of each stage, and the individual losses, as CLIPStats
+    ):
+        stage = StageRecorder(image.device, enabled = return_stats)
 
-        if self.decoupled_contrastive_learning:
-            pos_mask = torch.eye(b, device = device, dtype = torch.bool)
-            text_to_image_exp, image_to_text_exp = map(lambda t: t.masked_fill(pos_mask, 0.), (text_to_image_exp, image_to_text_exp))
+        # ssl
 
-        text_to_image_denom, image_to_text_denom = map(lambda t: t.sum(dim = -1), (text_to_image_exp, image_to_text_exp))
+        text_ssl_loss = 0
+        image_ssl_loss = 0
 
-        # loss
+        # the clean and masked text can be encoded in one batched pass of the text transformer (needs the text encoder to be trained)
 
-        text_to_image_loss = -log(text_to_image_pos / text_to_image_denom).mean()
-        image_to_text_loss = -log(image_to_text_pos / image_to_text_denom).mean()
+        mlm_single_text_pass = return_loss and self.use_mlm and self.mlm_single_text_pass and not freeze_text_encoder
 
-        cl_loss = (text_to_image_loss + image_to_text_loss) / 2
+        if return_loss:
+            with self.autocast(image.device):
+                if self.use_mlm and not mlm_single_text_pass:
+                    with stage('mlm'):
+                        text_ssl_loss = self.mlm(text, mask = text_mask)
+
+                if self.use_visual_ssl:
+                    with stage('visual_ssl'):
+                        image_ssl_loss = self.visual_ssl(image)
+
+        # get text and image encodings
+        # the image encoder can be frozen, in the case that the image net was pretrained as recommended in LiT
+
+        if mlm_single_text_pass:
+            b = text.shape[0]
+
+            with stage('mlm'):
+                masked_text, mlm_labels = self.mlm.get_masked_input_and_labels(text)
+
+            both_text = torch.cat((text, masked_text), dim = 0)
+            both_text_mask = torch.cat((text_mask, text_mask), dim = 0) if exists(text_mask) else None
+
+            with stage('text_encode'), self.autocast(text.device):
+                enc_text, enc_masked_text = self.text_transformer(both_text, mask = both_text_mask).split(b, dim = 0)
+
+            with stage('mlm'):
+                text_ssl_loss = self.mlm.get_loss(enc_masked_text, mlm_labels)
+        else:
+            with stage('text_encode'):
+                enc_text = self.encode_text(text, text_mask, freeze_text_encoder = freeze_text_encoder)
+
+        with stage('image_encode'):
+            enc_image = self.encode_image(image, freeze_image_encoder = freeze_image_encoder)
+
+        # project to latents
+
+        with stage('latent_projection'):
+            text_latents, text_latents_extra = self.get_text_latents_from_encoding(enc_text)
+            image_latents, image_latents_extra = self.get_image_latents_from_encoding(enc_image)
+
+        # early return, if needed
+
+        if not return_loss:
+            temp = self.temperature.exp()
+            einsum_args = (text_latents_extra, image_latents_extra) if self.extra_latent_projection and not text_to_image else (text_latents, image_latents)
+            einsum_eq = 'b t d, b i d -> b t i' if self.use_all_token_embeds else 'b d, b d -> b'
+            sim = einsum(einsum_eq, *einsum_args) * temp
+
+            if not return_stats:
+                return sim
+
+            return sim, CLIPStats(stage.times, stage.peak_memory, dict(), temp.detach())
+
+        # contrastive loss
+
+        with stage('contrastive_loss'):
+            cl_loss = self.get_contrastive_loss(text_latents, image_latents, text_latents_extra, image_latents_extra, text_mask = text_mask)
 
         # calculate weights
 
@@ -478,4 +970,118 @@ class CLIP(nn.Module):
             + (text_ssl_loss * self.text_ssl_loss_weight) \
             + (image_ssl_loss * self.image_ssl_loss_weight)
 
-        return loss
+        if not return_stats:
+            return loss
+
+        losses = dict(
+            contrastive = cl_loss,
+            mlm = text_ssl_loss,
+            visual_ssl = image_ssl_loss,
+            total = loss
+        )
+
+        losses = {name: detach_if_tensor(value) for name, value in losses.items()}
+        return loss, CLIPStats(stage.times, stage.peak_memory, losses, self.temperature.exp().detach())
+
+    def grad_cache_step(
+        self,
+        text,
+        image,
+        text_mask = None,
+        micro_batch_size = 64,
+        freeze_image_encoder = False,
+        freeze_text_encoder = False
+    ):
+        # gradient cached contrastive training (https://arxiv.org/abs/2101.06983)
+        # latents of the full batch are first computed micro-batch by micro-batch without keeping the graph
+        # the contrastive loss is then backpropagated to the detached latents, and each micro-batch is re-encoded to push the cached latent gradients through the encoders
+        # calls backward itself, and returns the (detached) loss for logging
+
+        b = text.shape[0]
+        micro_batches = range(0, b, micro_batch_size)
+
+        def micro_batch(t, start):
+            return t[start:(start + micro_batch_size)] if exists(t) else None
+
+        cl_loss_weight = 1 - (self.text_ssl_loss_weight + self.image_ssl_loss_weight)
+        total_loss = 0.
+
+        # ssl losses are per micro-batch, so can be backpropagated right away
+
+        for start in micro_batches:
+            text_chunk, image_chunk, mask_chunk = map(partial(micro_batch, start = start), (text, image, text_mask))
+            fraction = text_chunk.shape[0] / b
+
+            ssl_loss = 0.
+
+            # under the same precision policy as in forward
+
+            with self.autocast(image_chunk.device):
+                if self.use_mlm:
+                    ssl_loss = ssl_loss + self.mlm(text_chunk, mask = mask_chunk) * self.text_ssl_loss_weight
+
+                if self.use_visual_ssl:
+                    ssl_loss = ssl_loss + self.visual_ssl(image_chunk) * self.image_ssl_loss_weight
+
+            if torch.is_tensor(ssl_loss):
+                (ssl_loss * fraction).backward()
+                total_loss += ssl_loss.item() * fraction
+
+        # encode all micro-batches without the graph, recording the random state for replaying dropout on the second pass
+
+        rng_states = []
+        text_latents, text_latents_extra, image_latents, image_latents_extra = [], [], [], []
+
+        with torch.no_grad():
+            for start in micro_batches:
+                text_chunk, image_chunk, mask_chunk = map(partial(micro_batch, start = start), (text, image, text_mask))
+                rng_states.append(get_rng_state(text_chunk, image_chunk))
+
+                text_latent, text_latent_extra = self.get_text_latents(text_chunk, mask_chunk)
+                image_latent, image_latent_extra = self.get_image_latents(image_chunk)
+
+                text_latents.append(text_latent)
+                text_latents_extra.append(text_latent_extra)
+                image_latents.append(image_latent)
+                image_latents_extra.append(image_latent_extra)
+
+        if self.extra_latent_projection:
+            text_latents_extra, image_latents_extra = map(lambda t: torch.cat(t).requires_grad_(), (text_latents_extra, image_latents_extra))
+
+        text_latents, image_latents = map(lambda t: torch.cat(t).requires_grad_(), (text_latents, image_latents))
+
+        if not self.extra_latent_projection:
+            text_latents_extra, image_latents_extra = text_latents, image_latents
+
+        # contrastive loss over the full batch, caching the gradients of the latents
+
+        cl_loss = self.get_contrastive_loss(text_latents, image_latents, text_latents_extra, image_latents_extra, text_mask = text_mask)
+        (cl_loss * cl_loss_weight).backward()
+
+        total_loss += cl_loss.item() * cl_loss_weight
+
+        # re-encode each micro-batch with the graph, and backpropagate the cached latent gradients
+
+        latents = (text_latents, image_latents)
+
+        if self.extra_latent_projection:
+            latents = (*latents, text_latents_extra, image_latents_extra)
+
+        cached_grads = tuple(t.grad for t in latents)
+
+        for start, rng_state in zip(micro_batches, rng_states):
+            text_chunk, image_chunk, mask_chunk = map(partial(micro_batch, start = start), (text, image, text_mask))
+
+            with replay_rng_state(rng_state):
+                text_latent, text_latent_extra = self.get_text_latents(text_chunk, mask_chunk, freeze_text_encoder = freeze_text_encoder)
+                image_latent, image_latent_extra = self.get_image_latents(image_chunk, freeze_image_encoder = freeze_image_encoder)
+
+            micro_latents = (text_latent, image_latent)
+
+            if self.extra_latent_projection:
+                micro_latents = (*micro_latents, text_latent_extra, image_latent_extra)
+
+            micro_grads = tuple(micro_batch(grad, start) for grad in cached_grads)
+            torch.autograd.backward(micro_latents, micro_grads)
+
+        return torch.tensor(total_loss)
@@ -0,0 +1,147 @@
+import hashlib
+from pathlib import Path
+
+import torch
+from einops import rearrange, reduce
+
+from x_clip.x_clip import l2norm, filip_similarity, filip_text_to_image
+from x_clip.tokenizer import get_tokenizer
+
+# constants
+
+DEFAULT_TEMPLATES = ('a photo of a {}.',)
+
+# helper functions
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    return val if exists(val) else d
+
+def get_context_length(clip):
+    text_transformer = clip.text_transformer
+    assert hasattr(text_transformer, 'pos_emb'), 'context_length must be given for an external text encoder'
+    return text_transformer.pos_emb.num_embeddings
+
+def get_weights_hash(modules, hasher):
+    for module in modules:
+        for name, tensor in sorted(module.state_dict().items()):
+            hasher.update(name.encode('utf-8'))
+            hasher.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+
+# main class
+
+class ZeroShotClassifier:
+    def __init__(
+        self,
+        clip,
+        class_names,
+        templates = DEFAULT_TEMPLATES,  # prompt templates, with {} replaced by the class name, the embeddings of all templates of a class are averaged
+        tokenizer = None,
+        context_length = None,          # defaults to the maximum sequence length of the text transformer
+        cache_dir = None,               # if given, class embeddings are also cached on disk, keyed by the weights of the text tower and the prompts
+        batch_size = 256
+    ):
+        # class prompts are encoded once, after which classification only runs the image tower, followed by a single matmul against all classes
+        # with fine-grained (FILIP) CLIP, the token latents of every prompt are kept, and images are scored with the FILIP text to image similarity
+
+        self.clip = clip
+        self.class_names = list(class_names)
+        self.templates = list(templates)
+        self.tokenizer = tokenizer
+        self.context_length = default(context_length, get_context_length(clip))
+        self.cache_dir = Path(cache_dir) if exists(cache_dir) else None
+        self.batch_size = batch_size
+
+        self.cache = dict()
+        self.key = None
+
+    @property
+    def prompts(self):
+        return [template.format(class_name) for class_name in self.class_names for template in self.templates]
+
+    @property
+    def num_classes(self):
+        return len(self.class_names)
+
+    def get_cache_key(self):
+        # changes whenever the weights of the text tower, the latent projection, or the prompts change
+
+        clip = self.clip
+        hasher = hashlib.sha256()
+
+        get_weights_hash((clip.text_transformer, clip.to_text_latent), hasher)
+        hasher.update(repr((self.prompts, self.context_length, clip.use_all_token_embeds, clip.precision)).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def refresh(self):
+        # recomputes the cache key, call after the weights of CLIP were updated
+        self.key = self.get_cache_key()
+
+    @torch.inference_mode()
+    def encode_classes(self):
+        clip = self.clip
+        tokenizer = self.tokenizer if exists(self.tokenizer) else get_tokenizer()
+        device = next(clip.parameters()).device
+
+        text, text_mask = tokenizer.tokenize(self.prompts, context_length = self.context_length, truncate_text = True, pad_to_longest = True, return_mask = True)
+        text, text_mask = text.to(device), text_mask.to(device)
+
+        latents = clip.embed_text(text, text_mask, batch_size = self.batch_size)
+
+        if clip.use_all_token_embeds:
+            # token latents of every prompt, with the text mask, as FILIP similarities cannot be averaged across prompts before scoring
+            return dict(latents = latents, text_mask = text_mask)
+
+        latents = rearrange(latents, '(c t) d -> c t d', t = len(self.templates))
+        return dict(latents = l2norm(latents.mean(dim = 1)), text_mask = None)
+
+    def get_class_embeddings(self):
+        if not exists(self.key):
+            self.refresh()
+
+        if self.key in self.cache:
+            return self.cache[self.key]
+
+        device = next(self.clip.parameters()).device
+        cache_path = self.cache_dir / f'{self.key}.pt' if exists(self.cache_dir) else None
+
+        if exists(cache_path) and cache_path.exists():
+            embeddings = torch.load(str(cache_path), map_location = device)
+        else:
+            embeddings = self.encode_classes()
+
+            if exists(cache_path):
+                self.cache_dir.mkdir(parents = True, exist_ok = True)
+                torch.save(embeddings, str(cache_path))
+
+        self.cache[self.key] = embeddings
+        return embeddings
+
+    # scoring
+
+    @torch.inference_mode()
+    def logits_from_latents(self, image_latents):
+        # image latents as returned by CLIP.embed_image, returns logits of shape (batch, classes)
+
+        clip = self.clip
+        embeddings = self.get_class_embeddings()
+        class_latents, text_mask = embeddings['latents'], embeddings['text_mask']
+
+        temp = clip.temperature.exp()
+
+        if not clip.use_all_token_embeds:
+            return image_latents @ class_latents.t() * temp
+
+        sim = filip_similarity(filip_text_to_image, class_latents, image_latents, text_mask = text_mask, chunk_size = clip.filip_chunk_size)
+        sim = reduce(sim, '(c t) b -> b c', 'mean', t = len(self.templates))
+        return sim * temp
+
+    @torch.inference_mode()
+    def __call__(self, images):
+        image_latents = self.clip.embed_image(images, batch_size = self.batch_size)
+        return self.logits_from_latents(image_latents)
+
+    def predict(self, images):
+        return self(images).argmax(dim = -1)